@@ -1,16 +1,16 @@
-from cloudvolume import CloudVolume
-from caveclient import CAVEclient
-import pandas as pd
-import trimesh
 import argparse
 
 
+MINNIE65_SEG_PATH = 'precomputed://https://storage.googleapis.com/iarpa_microns/minnie/minnie65/seg'
 
 
-def download_mesh(segment_id, base_dir=""):
-    
+def download_mesh(segment_id, base_dir="", cloudpath=MINNIE65_SEG_PATH):
+    # CloudVolume and trimesh are only imported when a mesh is downloaded, they dominate startup time
+    from cloudvolume import CloudVolume
+    import trimesh
+
     # Set up oldest cloudvolume to collect mesh
-    cv = CloudVolume('precomputed://https://storage.googleapis.com/iarpa_microns/minnie/minnie65/seg',
+    cv = CloudVolume(cloudpath,
                     progress=False, # shows progress bar
                     cache=False, # cache to disk to avoid repeated downloads
                     fill_missing=False,)
@@ -23,7 +23,7 @@ def download_mesh(segment_id, base_dir=""):
         trimesh.exchange.export.export_mesh(mesh, f, file_type='off')
 
 
-def collect_synapses(segment_id, base_dir):
+def collect_synapses(segment_id, base_dir, client=None):
     """
     Function to collect all pre and postsynaptic endings involving neuron segment_id from client and save results as a csv file named segment_id_synapses.csv
 
@@ -32,10 +32,13 @@ def collect_synapses(segment_id, base_dir):
     segment_id : int
         ID of neuron segment to collect synapses from
     client : CAVEclient
-        Client with synapse information. Currently only supports microns data
+        Client with synapse information. Currently only supports microns data. Defaults to minnie65_public at version 117
     """
-    client = CAVEclient('minnie65_public')
-    client.version=117
+    if client is None:
+        from caveclient import CAVEclient
+
+        client = CAVEclient('minnie65_public')
+        client.version=117
     # Get synapses going from segment_id to other neurons
     pre_synapses = client.materialize.synapse_query(pre_ids = segment_id, split_positions=True)
     pre_synapses = pre_synapses[["pre_pt_root_id", "post_pt_root_id", "id", "pre_pt_position_x", "pre_pt_position_y", "pre_pt_position_z", "size"]]
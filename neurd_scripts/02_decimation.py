@@ -5,6 +5,7 @@ from datasci_tools import system_utils as su
 import trimesh
 import argparse
 import os
+import parallel_decimation as pdec
 
 
 if __name__ == "__main__":
@@ -12,19 +13,33 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--segment_id", default=864691136361538530, help="id of segment to download")
     parser.add_argument("--base_dir", default = "", help="base directory to save results in. Must end with /")
-    parser.add_argument("--decimation_ratio", default=0.062, help="ratio by which to decimate mesh")
+    parser.add_argument("--decimation_ratio", default=0.062, type=float, help="ratio by which to decimate mesh")
+    parser.add_argument("--decimator", default="tu", choices=["tu", "pyfqmr"], help="tu.decimate or pyfqmr with the holes of the mesh locked")
+    parser.add_argument("--n_workers", default=1, type=int, help="decimate spatial partitions of the mesh in this many processes, needs --decimator pyfqmr")
     args = parser.parse_args()
 
     segment_id = int(args.segment_id)
     base_dir = args.base_dir
     decimation_ratio = args.decimation_ratio
+    decimator = args.decimator
+    n_workers = args.n_workers
 
-    mesh = vdi.fetch_segment_id_mesh(
-        segment_id,
-    )
+    # partitions are decimated with pyfqmr, tu.decimate cannot lock the cuts between them
+    if n_workers > 1 and decimator != "pyfqmr":
+        raise Exception("--n_workers > 1 needs --decimator pyfqmr")
+
+    # use the mesh downloaded by 01_data_collection.py if there is one
+    if os.path.exists(f"{base_dir}{segment_id}.off"):
+        mesh = vdi.fetch_segment_id_mesh(
+            mesh_filepath = f"{base_dir}{segment_id}.off"
+        )
+    else:
+        mesh = vdi.fetch_segment_id_mesh(
+            segment_id,
+        )
 
     if os.path.exists(f"{base_dir}{segment_id}_products.pkl"):
-        products = load_object(f"{base_dir}{segment_id}_products.pkl")
+        products = su.load_object(f"{base_dir}{segment_id}_products.pkl")
     else:
         products = pipeline.PipelineProducts()
 
@@ -32,10 +47,23 @@ if __name__ == "__main__":
         decimation_ratio = decimation_ratio
     )
 
-    mesh_decimated = tu.decimate(
-        mesh,
-        **decimation_parameters
-    )
+    if decimator == "pyfqmr" and n_workers > 1:
+        # partitions are decimated with their shared borders locked and welded back together
+        mesh_decimated = pdec.decimate_parallel(
+            mesh,
+            n_workers = n_workers,
+            **decimation_parameters
+        )
+    elif decimator == "pyfqmr":
+        mesh_decimated = pdec.decimate_mesh(
+            mesh,
+            **decimation_parameters
+        )
+    else:
+        mesh_decimated = tu.decimate(
+            mesh,
+            **decimation_parameters
+        )
 
     with open(f"{base_dir}{segment_id}_decimated.off", "wb") as f:
         trimesh.exchange.export.export_mesh(mesh_decimated, f, file_type='off')
@@ -44,6 +72,8 @@ if __name__ == "__main__":
         stage = "decimation",
         attr_dict = dict(
             decimation_parameters = decimation_parameters,
+            decimator = decimator,
+            decimation_n_workers = n_workers,
             segment_id = segment_id,
         ),
     )
@@ -2,6 +2,7 @@ from neurd.vdi_microns import volume_data_interface as vdi
 from datasci_tools import system_utils as su
 from neurd import neuron
 import argparse
+import limb_parallel as lp
 
 
 if __name__ == "__main__":
@@ -9,10 +10,13 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--segment_id", default=864691136361538530, help="id of segment to download")
     parser.add_argument("--base_dir", default = "", help="base directory to save results in. Must end with /")
+    parser.add_argument("--n_workers", default=1, type=int, help="number of processes decomposing limbs in parallel")
+    parser.add_argument("--check_determinism", action="store_true", help="also decompose serially and fail if the results differ")
     args = parser.parse_args()
 
     segment_id = int(args.segment_id)
     base_dir = args.base_dir
+    n_workers = args.n_workers
 
     mesh_decimated = vdi.fetch_segment_id_mesh(
         mesh_filepath = f"{base_dir}{segment_id}_decimated.off"
@@ -22,17 +26,35 @@ if __name__ == "__main__":
         f"{base_dir}{segment_id}_products.pkl"
     )
 
-    neuron_obj = neuron.Neuron(
-        mesh = mesh_decimated,
-        segment_id = segment_id, # don't need this explicitely if segment_id is already in products
-        pipeline_products = products,
-        suppress_preprocessing_print=False,
-        suppress_output=False,
-    )
+    if n_workers > 1:
+        neuron_obj, limb_stats = lp.decompose_limbs_parallel(
+            mesh_decimated,
+            segment_id,
+            products,
+            n_workers = n_workers,
+        )
+        if limb_stats["n_serial_limbs"] > 0:
+            print(f"{limb_stats['n_serial_limbs']} limbs fell back to serial decomposition")
 
-    _ = neuron_obj.calculate_decomposition_products(
-        store_in_obj = True,
-    )
+        if args.check_determinism:
+            differences = lp.compare_neurons(
+                lp.build_neuron(mesh_decimated, segment_id, products),
+                neuron_obj,
+            )
+            if len(differences) > 0:
+                raise Exception(f"Parallel decomposition differs from serial decomposition: {differences}")
+    else:
+        neuron_obj = neuron.Neuron(
+            mesh = mesh_decimated,
+            segment_id = segment_id, # don't need this explicitely if segment_id is already in products
+            pipeline_products = products,
+            suppress_preprocessing_print=False,
+            suppress_output=False,
+        )
+
+        _ = neuron_obj.calculate_decomposition_products(
+            store_in_obj = True,
+        )
 
     vdi.save_neuron_obj(
         neuron_obj,
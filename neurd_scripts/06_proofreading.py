@@ -1,39 +1,36 @@
 import argparse
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
 from neurd.vdi_microns import volume_data_interface as vdi
 from neurd import neuron_utils as nru
 from neurd import neuron_pipeline_utils as npu
+import shared_mesh as shm
 
 
-if __name__ == "__main__":
-
-    parser = argparse.ArgumentParser()
-    parser.add_argument("--segment_id", default=864691136361538530, help="id of segment to download")
-    parser.add_argument("--base_dir", default = "", help="base directory to save results in. Must end with /")
-    parser.add_argument("--split_num", default=1, help="split to proofread")
-    args = parser.parse_args()
-
-    segment_id = int(args.segment_id)
-    base_dir = args.base_dir
-    split_num = args.split_num
-
-    synapse_filepath = str(Path(f'{base_dir}{segment_id}_synapses.csv').absolute())
-    
-    vdi.set_synapse_filepath(
-        synapse_filepath
-    )
-
-    mesh_decimated = vdi.fetch_segment_id_mesh(
-        mesh_filepath = f"{base_dir}{segment_id}_decimated.off"
-    )
+def proofread_split(segment_id, base_dir, split_num, mesh_decimated):
+    """
+    Runs axon/dendrite classification and automatic proofreading on one split of a neuron and
+    saves the results with suffixes _split_{split_num}_axon and _split_{split_num}_proofread
 
+    Parameters
+    ----------
+    segment_id : int
+        ID of neuron segment
+    base_dir : str
+        Directory the pipeline results are saved in. Must end with /
+    split_num : int
+        Split to proofread, as saved by 05_soma_splitting.py
+    mesh_decimated : trimesh.Trimesh
+        Decimated mesh of the whole segment
+    """
     neuron_obj_path = Path(f"{base_dir}{segment_id}_split_{split_num}.pbz2")
-    
+
     if not neuron_obj_path.exists():
         raise Exception(f"Could not find neuron object at {neuron_obj_path}")
 
     neuron_obj = nru.decompress_neuron(
         filepath = neuron_obj_path,
-        original_mesh = mesh_decimated, 
+        original_mesh = mesh_decimated,
         suppress_output = False
     )
 
@@ -45,7 +42,7 @@ if __name__ == "__main__":
 
     vdi.save_neuron_obj(
         neuron_obj_axon,
-        suffix=f"_split_{i}_axon.pbz2",
+        suffix=f"_split_{split_num}_axon.pbz2",
     )
 
     neuron_obj_proof = npu.auto_proof_stage(
@@ -56,8 +53,72 @@ if __name__ == "__main__":
 
     vdi.save_neuron_obj_auto_proof(
         neuron_obj_proof,
-        suffix=f"_split_{i}_proofread.pbz2",
+        suffix=f"_split_{split_num}_proofread.pbz2",
+    )
+
+
+def find_split_nums(segment_id, base_dir):
+    """
+    Finds the numbers of all splits saved by 05_soma_splitting.py for a segment
+    """
+    prefix = f"{segment_id}_split_"
+    split_names = [p.name[len(prefix):-len(".pbz2")] for p in Path(base_dir or ".").glob(f"{prefix}*.pbz2")]
+    # skip _split_i_axon.pbz2 and _split_i_proofread.pbz2 results
+    return sorted(int(name) for name in split_names if name.isdigit())
+
+
+def _proofread_split_worker(segment_id, base_dir, split_num, synapse_filepath):
+    # workers set up their own synapse source and use the mesh attached by shm.init_worker
+    vdi.set_synapse_filepath(
+        synapse_filepath
+    )
+    proofread_split(segment_id, base_dir, split_num, shm.worker_mesh())
+    return split_num
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--segment_id", default=864691136361538530, help="id of segment to download")
+    parser.add_argument("--base_dir", default = "", help="base directory to save results in. Must end with /")
+    parser.add_argument("--split_num", default=1, help="split to proofread, 'all' proofreads every split")
+    parser.add_argument("--n_workers", default=1, type=int, help="number of processes proofreading splits in parallel")
+    args = parser.parse_args()
+
+    segment_id = int(args.segment_id)
+    base_dir = args.base_dir
+    split_num = args.split_num
+    n_workers = args.n_workers
+
+    synapse_filepath = str(Path(f'{base_dir}{segment_id}_synapses.csv').absolute())
+
+    vdi.set_synapse_filepath(
+        synapse_filepath
+    )
+
+    mesh_decimated = vdi.fetch_segment_id_mesh(
+        mesh_filepath = f"{base_dir}{segment_id}_decimated.off"
     )
 
+    if split_num == "all":
+        split_nums = find_split_nums(segment_id, base_dir)
+    else:
+        split_nums = [int(split_num)]
 
-    
\ No newline at end of file
+    if n_workers > 1 and len(split_nums) > 1:
+        # workers attach to one shared copy of the decimated mesh instead of each unpickling their own
+        with shm.SharedMesh(mesh_decimated) as shared_mesh:
+            with ProcessPoolExecutor(
+                min(n_workers, len(split_nums)),
+                initializer=shm.init_worker,
+                initargs=(shared_mesh.handle,),
+            ) as executor:
+                futures = [
+                    executor.submit(_proofread_split_worker, segment_id, base_dir, n, synapse_filepath)
+                    for n in split_nums
+                ]
+                for future in futures:
+                    print(f"Finished proofreading split {future.result()}")
+    else:
+        for n in split_nums:
+            proofread_split(segment_id, base_dir, n, mesh_decimated)
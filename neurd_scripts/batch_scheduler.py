@@ -0,0 +1,472 @@
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import subprocess
+import argparse
+import psutil
+import json
+import time
+import sys
+import os
+
+
+# stages whose cost is predicted and scheduled. Stages 01-03 have to be finished for the features to exist
+DEFAULT_STAGES = ["04_decomposition.py", "05_soma_splitting.py"]
+
+FEATURE_NAMES = ["raw_faces", "decimated_faces", "n_somas", "n_synapses"]
+TARGET_NAMES = ["runtime_s", "peak_memory_mb"]
+
+
+def count_off_faces(filepath):
+    """
+    Reads the number of faces from the header of an .off file without loading the mesh.
+
+    Parameters
+    ----------
+    filepath : str
+        Path to the .off file
+
+    Returns
+    -------
+    int
+        Number of faces in the mesh, 0 if the file does not exist
+    """
+    if not os.path.exists(filepath):
+        return 0
+
+    with open(filepath, "r") as f:
+        for line in f:
+            line = line.strip()
+            # skip the OFF keyword, comments and empty lines
+            if not line or line.startswith("#") or line.startswith("OFF"):
+                continue
+            return int(line.split()[1])
+
+    return 0
+
+
+def count_somas(products_filepath):
+    """
+    Counts the somas found in stage 03 (soma identification) of a products file.
+
+    Parameters
+    ----------
+    products_filepath : str
+        Path to the pickled pipeline products of a segment
+
+    Returns
+    -------
+    int
+        Number of soma meshes stored in the products, 0 if soma identification was not run
+    """
+    if not os.path.exists(products_filepath):
+        return 0
+
+    from datasci_tools import system_utils as su
+
+    products = su.load_object(products_filepath)
+    soma_products = getattr(products, "soma_identification", None)
+    soma_meshes = getattr(soma_products, "soma_meshes", None)
+
+    if soma_meshes is None:
+        return 0
+    return len(soma_meshes)
+
+
+def count_synapses(synapse_filepath):
+    """
+    Counts the synapses in a csv file written by 01_data_collection.py.
+
+    Parameters
+    ----------
+    synapse_filepath : str
+        Path to the synapse csv file
+
+    Returns
+    -------
+    int
+        Number of synapses, 0 if the file does not exist
+    """
+    if not os.path.exists(synapse_filepath):
+        return 0
+
+    with open(synapse_filepath, "r") as f:
+        n_lines = sum(1 for _ in f)
+
+    # only the presynaptic part is written with a header
+    return max(n_lines - 1, 0)
+
+
+def collect_features(segment_id, base_dir=""):
+    """
+    Collects the cheap features used to predict runtime and peak memory of a segment from the
+    files written by stages 01-03.
+
+    Parameters
+    ----------
+    segment_id : int
+        ID of neuron segment
+    base_dir : str
+        Directory the pipeline results are saved in. Must end with /
+
+    Returns
+    -------
+    dict
+        Feature values keyed by the names in FEATURE_NAMES
+    """
+    return dict(
+        raw_faces = count_off_faces(f"{base_dir}{segment_id}.off"),
+        decimated_faces = count_off_faces(f"{base_dir}{segment_id}_decimated.off"),
+        n_somas = count_somas(f"{base_dir}{segment_id}_products.pkl"),
+        n_synapses = count_synapses(f"{base_dir}{segment_id}_synapses.csv"),
+    )
+
+
+def feature_matrix(features):
+    """
+    Turns a dataframe of features into the design matrix of the cost model.
+    Counts enter in log space since runtime and memory grow roughly as a power of the mesh size.
+
+    Parameters
+    ----------
+    features : pd.DataFrame
+        Dataframe with one column per name in FEATURE_NAMES
+
+    Returns
+    -------
+    np.ndarray
+        Design matrix of shape (n_segments, len(FEATURE_NAMES) + 1), first column is the intercept
+    """
+    X = np.log1p(features[FEATURE_NAMES].to_numpy(dtype=float))
+    return np.hstack([np.ones((X.shape[0], 1)), X])
+
+
+def fit_cost_model(runs, stages=DEFAULT_STAGES):
+    """
+    Fits a log-linear model of runtime and peak memory for every stage on recorded past runs.
+
+    Parameters
+    ----------
+    runs : pd.DataFrame
+        Recorded runs as written by record_runs. Needs the columns stage, FEATURE_NAMES and TARGET_NAMES
+    stages : list
+        Stages to fit a model for
+
+    Returns
+    -------
+    dict
+        Coefficients per stage and target: model[stage][target] = list of coefficients
+    """
+    model = dict()
+    for stage in stages:
+        stage_runs = runs[(runs["stage"] == stage) & (runs["returncode"] == 0)]
+        if len(stage_runs) == 0:
+            raise Exception(f"No successful recorded runs for stage {stage}")
+
+        X = feature_matrix(stage_runs)
+        model[stage] = dict()
+        for target in TARGET_NAMES:
+            y = np.log(np.maximum(stage_runs[target].to_numpy(dtype=float), 1e-3))
+            # least squares with a small ridge term so that few recorded runs still give a stable fit
+            ridge = 1e-3 * np.eye(X.shape[1])
+            ridge[0, 0] = 0
+            coefficients = np.linalg.solve(X.T @ X + ridge, X.T @ y)
+            model[stage][target] = coefficients.tolist()
+
+    return model
+
+
+def predict_costs(model, features):
+    """
+    Predicts runtime and peak memory of every segment in features.
+    Stages of one segment run one after another, so runtimes add up and the peak memory is the
+    largest peak of any stage.
+
+    Parameters
+    ----------
+    model : dict
+        Model as returned by fit_cost_model
+    features : pd.DataFrame
+        Dataframe with a segment_id column and one column per name in FEATURE_NAMES
+
+    Returns
+    -------
+    pd.DataFrame
+        segment_id, runtime_s and peak_memory_mb per segment
+    """
+    X = feature_matrix(features)
+    runtime = np.zeros(len(features))
+    peak_memory = np.zeros(len(features))
+
+    for stage, coefficients in model.items():
+        runtime += np.exp(X @ np.array(coefficients["runtime_s"]))
+        peak_memory = np.maximum(peak_memory, np.exp(X @ np.array(coefficients["peak_memory_mb"])))
+
+    return pd.DataFrame(dict(
+        segment_id = features["segment_id"].to_numpy(),
+        runtime_s = runtime,
+        peak_memory_mb = peak_memory,
+    ))
+
+
+def pack_jobs(predictions, memory_budget_mb, n_workers):
+    """
+    Packs segments into batches that run concurrently. Every batch holds at most n_workers
+    segments and their summed predicted peak memory stays under memory_budget_mb.
+    Segments are placed largest-first into the first batch they fit in (first fit decreasing).
+
+    Parameters
+    ----------
+    predictions : pd.DataFrame
+        Predictions as returned by predict_costs
+    memory_budget_mb : float
+        Memory available to one batch
+    n_workers : int
+        Maximum number of segments running at the same time
+
+    Returns
+    -------
+    list
+        List of batches, each a list of segment ids
+    """
+    order = np.argsort(-predictions["peak_memory_mb"].to_numpy(), kind="stable")
+
+    batches = []
+    batch_memory = []
+    for idx in order:
+        segment_id = int(predictions["segment_id"].iloc[idx])
+        memory = float(predictions["peak_memory_mb"].iloc[idx])
+
+        if memory > memory_budget_mb:
+            print(f"Warning: segment {segment_id} is predicted to need {memory:.0f} MB, "
+                  f"more than the budget of {memory_budget_mb:.0f} MB. Running it alone")
+
+        for i in range(len(batches)):
+            if len(batches[i]) < n_workers and batch_memory[i] + memory <= memory_budget_mb:
+                batches[i].append(segment_id)
+                batch_memory[i] += memory
+                break
+        else:
+            batches.append([segment_id])
+            batch_memory.append(memory)
+
+    return batches
+
+
+def process_tree_rss(pid):
+    """
+    Summed resident memory in bytes of a process and all of its descendants (e.g. the workers of
+    process pools started by a stage). Pages shared between the processes are counted once per process,
+    so this errs on the high side, which is the safe side for packing batches into a memory budget.
+    """
+    try:
+        process = psutil.Process(pid)
+        processes = [process] + process.children(recursive=True)
+    except psutil.NoSuchProcess:
+        return 0
+
+    rss = 0
+    for p in processes:
+        try:
+            rss += p.memory_info().rss
+        except psutil.NoSuchProcess:
+            # exited between listing and sampling
+            pass
+    return rss
+
+
+def run_stage(stage, segment_id, base_dir="", script_dir=None, extra_args=None, sample_interval=0.1):
+    """
+    Runs a single stage script on a segment and measures its runtime and peak memory.
+
+    Peak memory is the largest summed resident memory of the stage process and all of its
+    descendants, sampled every sample_interval seconds, so stages that start process pools
+    are recorded with the memory of all their workers.
+
+    Parameters
+    ----------
+    stage : str
+        Filename of the stage script, e.g. 04_decomposition.py
+    segment_id : int
+        ID of neuron segment
+    base_dir : str
+        Directory the pipeline results are saved in. Must end with /
+    script_dir : str
+        Directory containing the stage scripts, defaults to the directory of this file
+    extra_args : list
+        Additional command line arguments of the stage script
+    sample_interval : float
+        Seconds between memory samples
+
+    Returns
+    -------
+    dict
+        stage, segment_id, returncode, runtime_s and peak_memory_mb of the run
+    """
+    if script_dir is None:
+        script_dir = Path(__file__).parent
+
+    start = time.time()
+    process = subprocess.Popen([
+        sys.executable, str(Path(script_dir) / stage),
+        "--segment_id", str(segment_id),
+        "--base_dir", base_dir,
+    ] + list(extra_args or []))
+
+    peak_rss = 0
+    while process.poll() is None:
+        peak_rss = max(peak_rss, process_tree_rss(process.pid))
+        time.sleep(sample_interval)
+
+    return dict(
+        stage = stage,
+        segment_id = segment_id,
+        returncode = process.returncode,
+        runtime_s = time.time() - start,
+        peak_memory_mb = peak_rss / 1024**2,
+    )
+
+
+def run_segment(segment_id, base_dir="", stages=DEFAULT_STAGES):
+    """
+    Runs all stages on a segment one after another, stopping at the first failing stage.
+
+    Returns
+    -------
+    list
+        One record per stage that was run, see run_stage
+    """
+    records = []
+    for stage in stages:
+        record = run_stage(stage, segment_id, base_dir)
+        records.append(record)
+        if record["returncode"] != 0:
+            print(f"Stage {stage} failed for segment {segment_id}")
+            break
+    return records
+
+
+def record_runs(records, features, runs_csv):
+    """
+    Appends run records together with the features of their segments to the recorded runs file.
+    """
+    records = pd.DataFrame(records).merge(features, on="segment_id", how="left")
+    records.to_csv(runs_csv, mode="a", header=not os.path.exists(runs_csv), index=False)
+    return records
+
+
+def prediction_error(predictions, records):
+    """
+    Compares predicted costs with the measured costs of the segments in records.
+
+    Parameters
+    ----------
+    predictions : pd.DataFrame
+        Predictions as returned by predict_costs
+    records : pd.DataFrame
+        Run records as returned by record_runs
+
+    Returns
+    -------
+    dict
+        Mean absolute percentage error of runtime and peak memory
+    """
+    measured = records.groupby("segment_id").agg(
+        runtime_s = ("runtime_s", "sum"),
+        peak_memory_mb = ("peak_memory_mb", "max"),
+    ).reset_index()
+    compared = measured.merge(predictions, on="segment_id", suffixes=("", "_predicted"))
+
+    error = dict()
+    for target in TARGET_NAMES:
+        relative_error = np.abs(compared[f"{target}_predicted"] - compared[target]) / np.maximum(compared[target], 1e-3)
+        error[target] = 100 * float(relative_error.mean())
+    return error
+
+
+def run_batches(batches, predictions, features, base_dir="", stages=DEFAULT_STAGES, runs_csv=None):
+    """
+    Runs every batch with its segments in parallel and reports the prediction error after each batch.
+    Measured runs are appended to runs_csv so the model can be refit on them.
+    """
+    for i, batch in enumerate(batches):
+        batch_memory = predictions[predictions["segment_id"].isin(batch)]["peak_memory_mb"].sum()
+        print(f"Batch {i + 1}/{len(batches)}: {len(batch)} segments, predicted peak memory {batch_memory:.0f} MB")
+
+        with ThreadPoolExecutor(max_workers=len(batch)) as executor:
+            results = list(executor.map(lambda segment_id: run_segment(segment_id, base_dir, stages), batch))
+
+        records = [record for segment_records in results for record in segment_records]
+        if runs_csv is not None:
+            records = record_runs(records, features, runs_csv)
+        else:
+            records = pd.DataFrame(records)
+
+        error = prediction_error(predictions, records[records["returncode"] == 0])
+        print(f"Batch {i + 1} prediction error: runtime {error['runtime_s']:.1f}%, "
+              f"peak memory {error['peak_memory_mb']:.1f}%")
+
+
+if __name__ == "__main__":
+    # Predicts the cost of stages 04 and 05 from features of stages 01-03 and packs segments into batches
+    # that fit the memory budget.
+    #   fit:  fit the cost model on recorded runs and save it to --model_path
+    #   plan: print the batches without running them
+    #   run:  run the batches, record the measured costs and report the prediction error after each batch
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mode", default="plan", choices=["fit", "plan", "run"])
+    parser.add_argument("--segment_ids", nargs="*", default=[], help="ids of segments to schedule")
+    parser.add_argument("--segment_id_file", default=None, help="file with one segment id per line")
+    parser.add_argument("--base_dir", default = "", help="base directory to save results in. Must end with /")
+    parser.add_argument("--runs_csv", default="recorded_runs.csv", help="csv file with recorded past runs")
+    parser.add_argument("--model_path", default="cost_model.json", help="file the fitted model is saved to")
+    parser.add_argument("--memory_budget_gb", default=64, type=float, help="memory available to a batch")
+    parser.add_argument("--n_workers", default=4, type=int, help="maximum number of segments run at the same time")
+    parser.add_argument("--stages", nargs="*", default=DEFAULT_STAGES, help="stage scripts to run per segment")
+    args = parser.parse_args()
+
+    if args.mode == "fit":
+        model = fit_cost_model(pd.read_csv(args.runs_csv), stages=args.stages)
+        with open(args.model_path, "w") as f:
+            json.dump(model, f, indent=4)
+        print(f"Saved cost model to {args.model_path}")
+        sys.exit(0)
+
+    segment_ids = [int(s) for s in args.segment_ids]
+    if args.segment_id_file is not None:
+        with open(args.segment_id_file, "r") as f:
+            segment_ids += [int(line) for line in f if line.strip()]
+
+    features = pd.DataFrame([dict(segment_id=s, **collect_features(s, args.base_dir)) for s in segment_ids])
+
+    if os.path.exists(args.model_path):
+        with open(args.model_path, "r") as f:
+            model = json.load(f)
+        predictions = predict_costs(model, features)
+    else:
+        # without recorded runs every segment gets the whole budget, which records a first set of runs safely
+        print(f"No cost model at {args.model_path}, running one segment per batch")
+        predictions = pd.DataFrame(dict(
+            segment_id = features["segment_id"].to_numpy(),
+            runtime_s = np.zeros(len(features)),
+            peak_memory_mb = np.full(len(features), args.memory_budget_gb * 1024),
+        ))
+
+    batches = pack_jobs(predictions, args.memory_budget_gb * 1024, args.n_workers)
+
+    for i, batch in enumerate(batches):
+        batch_predictions = predictions[predictions["segment_id"].isin(batch)]
+        print(f"Batch {i + 1}: {batch} predicted runtime {batch_predictions['runtime_s'].max():.0f} s, "
+              f"peak memory {batch_predictions['peak_memory_mb'].sum():.0f} MB")
+
+    if args.mode == "run":
+        run_batches(
+            batches,
+            predictions,
+            features,
+            base_dir=args.base_dir,
+            stages=args.stages,
+            runs_csv=args.runs_csv,
+        )
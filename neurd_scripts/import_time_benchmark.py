@@ -0,0 +1,133 @@
+from pathlib import Path
+import subprocess
+import argparse
+import time
+import sys
+import os
+
+
+SCRIPT_DIR = Path(__file__).parent
+
+DEFAULT_SCRIPTS = [
+    SCRIPT_DIR / "01_data_collection.py",
+    SCRIPT_DIR / "02_decimation.py",
+    SCRIPT_DIR / "03_soma_identification.py",
+    SCRIPT_DIR / "04_decomposition.py",
+    SCRIPT_DIR / "05_soma_splitting.py",
+    SCRIPT_DIR / "06_proofreading.py",
+    SCRIPT_DIR / "proofreading_python.py",
+    SCRIPT_DIR.parent / "scripts" / "axon_detection_and_proofreading.py",
+]
+
+# imports a script under a name other than __main__ so that only its module level code runs
+LOADER = """
+import importlib.util, sys
+sys.path.insert(0, {directory!r})
+spec = importlib.util.spec_from_file_location("_import_time_benchmark", {path!r})
+module = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(module)
+"""
+
+
+def parse_importtime(stderr):
+    """
+    Parses the output of python -X importtime into the cumulative import time of every top level import.
+
+    Parameters
+    ----------
+    stderr : str
+        stderr of a python process run with -X importtime
+
+    Returns
+    -------
+    dict
+        cumulative import time in ms of every module imported at the top level
+    """
+    top_level = dict()
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        # nested imports are indented below the module importing them
+        if name.startswith("  "):
+            continue
+        top_level[name.strip()] = int(cumulative) / 1000
+    return top_level
+
+
+def measure_startup(script, n_repeats=3):
+    """
+    Measures the startup of a script: the time to import everything at its module level.
+
+    Parameters
+    ----------
+    script : str
+        Path to the script
+    n_repeats : int
+        Number of runs, the fastest one is reported so that cold disk caches do not count
+
+    Returns
+    -------
+    dict
+        wall time, total import time and the cumulative time of every top level import in ms,
+        or the error if the script's imports fail
+    """
+    script = Path(script).absolute()
+    loader = LOADER.format(directory=str(script.parent), path=str(script))
+
+    best = None
+    for _ in range(n_repeats):
+        start = time.time()
+        process = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", loader],
+            capture_output=True,
+            text=True,
+        )
+        wall_ms = (time.time() - start) * 1000
+
+        if process.returncode != 0:
+            return dict(error=process.stderr.strip().splitlines()[-1])
+
+        imports = parse_importtime(process.stderr)
+        if best is None or wall_ms < best["wall_ms"]:
+            best = dict(
+                wall_ms = wall_ms,
+                import_ms = sum(imports.values()),
+                imports = imports,
+            )
+    return best
+
+
+if __name__ == "__main__":
+    # Reports the startup time of the pipeline entry points and appends it to --output_csv to track it over time
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scripts", nargs="*", default=DEFAULT_SCRIPTS, help="scripts to measure")
+    parser.add_argument("--n_repeats", default=3, type=int, help="runs per script, the fastest is reported")
+    parser.add_argument("--n_top", default=5, type=int, help="number of slowest imports to print per script")
+    parser.add_argument("--output_csv", default=None, help="csv file the results are appended to")
+    args = parser.parse_args()
+
+    rows = []
+    for script in args.scripts:
+        result = measure_startup(script, n_repeats=args.n_repeats)
+        name = Path(script).name
+
+        if "error" in result:
+            print(f"{name}: failed to import ({result['error']})")
+            continue
+
+        print(f"{name}: {result['wall_ms']:.0f} ms wall, {result['import_ms']:.0f} ms importing")
+        slowest = sorted(result["imports"].items(), key=lambda item: -item[1])[:args.n_top]
+        for module, ms in slowest:
+            print(f"    {module}: {ms:.0f} ms")
+
+        rows.append(f"{time.strftime('%Y-%m-%d %H:%M:%S')},{name},{result['wall_ms']:.1f},{result['import_ms']:.1f}")
+
+    if args.output_csv is not None:
+        write_header = not os.path.exists(args.output_csv)
+        with open(args.output_csv, "a") as f:
+            if write_header:
+                f.write("time,script,wall_ms,import_ms\n")
+            for row in rows:
+                f.write(row + "\n")
@@ -0,0 +1,394 @@
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import threading
+import tempfile
+import argparse
+import json
+import time
+from script_utils import load_script
+
+
+SCRIPT_DIR = Path(__file__).parent
+
+
+class FaultInjector:
+    """
+    Adds latency, limited bandwidth and random errors to the responses of the stand-ins.
+
+    Parameters
+    ----------
+    latency : float
+        Seconds added to every request
+    bandwidth : float
+        Bytes per second a response is sent with, None for unlimited
+    error_rate : float
+        Probability of a request failing
+    seed : int
+        Random seed of the errors
+    """
+    def __init__(self, latency=0.0, bandwidth=None, error_rate=0.0, seed=0):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self._rng = np.random.default_rng(seed)
+        self._lock = threading.Lock()
+
+    def should_fail(self):
+        with self._lock:
+            return self._rng.random() < self.error_rate
+
+    def delay(self, n_bytes):
+        """
+        Sleeps for the time a response of n_bytes takes to arrive.
+        """
+        transfer_time = n_bytes / self.bandwidth if self.bandwidth else 0.0
+        time.sleep(self.latency + transfer_time)
+
+    def apply(self, n_bytes):
+        """
+        Delays a response of n_bytes and raises ConnectionError if the request fails.
+        """
+        self.delay(n_bytes)
+        if self.should_fail():
+            raise ConnectionError("Injected error")
+
+
+def make_meshes(segment_ids, subdivisions=5, seed=0):
+    """
+    Synthetic meshes, one noisy sphere per segment placed at a random position of the volume.
+
+    Returns
+    -------
+    dict
+        (vertices, faces) keyed by segment id
+    """
+    import trimesh
+
+    rng = np.random.default_rng(seed)
+    sphere = trimesh.creation.icosphere(subdivisions=subdivisions, radius=5000)
+    meshes = dict()
+    for segment_id in segment_ids:
+        vertices = sphere.vertices * rng.uniform(0.5, 2.0) + rng.uniform(0, 1e6, size=3)
+        vertices += rng.normal(scale=50, size=vertices.shape)
+        meshes[segment_id] = (vertices.astype(np.float32), sphere.faces.astype(np.uint32))
+    return meshes
+
+
+def make_synapse_table(segment_ids, n_synapses=1000, seed=0):
+    """
+    Synthetic synapse table with the columns of a CAVE synapse query with split_positions.
+    Every synapse has one of segment_ids as pre- or postsynaptic partner.
+    """
+    rng = np.random.default_rng(seed)
+    n = n_synapses * len(segment_ids)
+    segment_ids = np.asarray(segment_ids, dtype=np.int64)
+    partners = rng.integers(864691130000000000, 864691140000000000, size=n, dtype=np.int64)
+    is_pre = rng.random(n) < 0.5
+    own = np.repeat(segment_ids, n_synapses)
+
+    table = dict(
+        id = np.arange(n),
+        pre_pt_root_id = np.where(is_pre, own, partners),
+        post_pt_root_id = np.where(is_pre, partners, own),
+        size = rng.integers(100, 10000, size=n),
+    )
+    positions = rng.uniform(0, 1e6, size=(n, 3)).astype(int)
+    for prefix in ["pre_pt_position", "post_pt_position"]:
+        for i, axis in enumerate("xyz"):
+            table[f"{prefix}_{axis}"] = positions[:, i]
+    return pd.DataFrame(table)
+
+
+def make_proofreading_tables(n_cells=100, n_new=20, seed=0):
+    """
+    Synthetic proofreading status tables of an old and a new materialization, the new one containing n_new more cells.
+    """
+    rng = np.random.default_rng(seed)
+    root_ids = rng.integers(864691130000000000, 864691140000000000, size=n_cells + n_new, dtype=np.int64)
+    positions = rng.integers(0, 200000, size=(n_cells + n_new, 3))
+    table = pd.DataFrame(dict(
+        pt_root_id = root_ids,
+        pt_position_x = positions[:, 0],
+        pt_position_y = positions[:, 1],
+        pt_position_z = positions[:, 2],
+    ))
+    return dict(
+        proofreading_status_public_release = table.iloc[:n_cells].reset_index(drop=True),
+        proofreading_status_and_strategy = table,
+    )
+
+
+class LocalMaterializationClient:
+    """
+    Stand-in for CAVEclient.materialize answering synapse queries and table queries from dataframes.
+    """
+    def __init__(self, synapses, tables, faults):
+        self.synapses = synapses
+        self.tables = tables
+        self.faults = faults
+
+    def _respond(self, result):
+        self.faults.apply(result.memory_usage(index=False).sum())
+        return result.copy()
+
+    def synapse_query(self, pre_ids=None, post_ids=None, split_positions=True):
+        mask = np.ones(len(self.synapses), dtype=bool)
+        if pre_ids is not None:
+            mask &= self.synapses["pre_pt_root_id"].isin(np.atleast_1d(pre_ids)).to_numpy()
+        if post_ids is not None:
+            mask &= self.synapses["post_pt_root_id"].isin(np.atleast_1d(post_ids)).to_numpy()
+        return self._respond(self.synapses[mask].reset_index(drop=True))
+
+    def query_table(self, table_name, split_positions=True):
+        return self._respond(self.tables[table_name])
+
+
+class LocalCAVEclient:
+    """
+    Stand-in for CAVEclient serving synthetic synapse and proofreading tables.
+    """
+    def __init__(self, synapses=None, tables=None, faults=None, version=117):
+        self.version = version
+        self.materialize = LocalMaterializationClient(
+            synapses if synapses is not None else make_synapse_table([]),
+            tables if tables is not None else make_proofreading_tables(),
+            faults if faults is not None else FaultInjector(),
+        )
+
+
+class LocalImageryClient:
+    """
+    Stand-in for imageryclient.ImageryClient returning synthetic segmentation cutouts: a sphere of one label
+    in the center of the cutout on a background of random labels.
+    """
+    def __init__(self, faults=None, seed=0):
+        self.faults = faults if faults is not None else FaultInjector()
+        self.seed = seed
+
+    def segmentation_cutout(self, ctr, bbox_size, mip=0):
+        shape = np.maximum(np.asarray(bbox_size) // 2 ** mip, 1)
+        rng = np.random.default_rng(self.seed)
+        seg = rng.integers(1, 100, size=shape, dtype=np.uint64)
+
+        grid = np.ogrid[tuple(slice(0, s) for s in shape)]
+        distance = sum(((g - s / 2) / (s / 2)) ** 2 for g, s in zip(grid, shape))
+        seg[distance < 0.25] = 864691135526405723
+
+        self.faults.apply(seg.nbytes)
+        return seg
+
+
+class _PrecomputedHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        server = self.server
+        data = server.files.get(self.path.split("?")[0].lstrip("/"))
+
+        if data is None:
+            self.send_response(404)
+            self.end_headers()
+            return
+
+        # shard files are read with range requests
+        status = 200
+        byte_range = self.headers.get("Range")
+        if byte_range is not None and byte_range.startswith("bytes="):
+            start, end = byte_range[len("bytes="):].split("-")
+            data = data[int(start):int(end) + 1]
+            status = 206
+
+        server.faults.delay(len(data))
+        if server.faults.should_fail():
+            self.send_response(503)
+            self.end_headers()
+            return
+
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class LocalPrecomputedServer:
+    """
+    HTTP server serving synthetic meshes as sharded multi-resolution precomputed meshes, so that CloudVolume
+    downloads them the same way as from the public bucket. Use cloudpath in place of the bucket path.
+
+    Parameters
+    ----------
+    meshes : dict
+        (vertices, faces) keyed by segment id, see make_meshes
+    faults : FaultInjector
+        Latency, bandwidth and errors of the responses
+    port : int
+        Port to listen on, 0 picks a free one
+    """
+    def __init__(self, meshes, faults=None, port=0):
+        self._server = ThreadingHTTPServer(("127.0.0.1", port), _PrecomputedHandler)
+        self._server.daemon_threads = True
+        self._server.faults = faults if faults is not None else FaultInjector()
+        self._server.files = self._make_files(meshes)
+        self._thread = None
+
+    @staticmethod
+    def _make_files(meshes):
+        from cloudvolume.datasource.precomputed.sharding import synthesize_shard_files
+        import precomputed_export as pe
+
+        # sharded multi-resolution draco meshes, the format of the minnie65 segmentation bucket
+        mesh_spec = pe.sharding_spec(len(meshes), data_encoding="raw")
+        encoded = {segment_id: pe.encode_multilod_draco(pe.mesh_lods(vertices, faces)) for segment_id, (vertices, faces) in meshes.items()}
+
+        info = {
+            "type": "segmentation",
+            "data_type": "uint64",
+            "num_channels": 1,
+            "mesh": "mesh",
+            "scales": [{
+                "key": "8_8_40",
+                "resolution": [8, 8, 40],
+                "size": [200000, 200000, 30000],
+                "voxel_offset": [0, 0, 0],
+                "chunk_sizes": [[256, 256, 32]],
+                "encoding": "raw",
+            }],
+        }
+        mesh_info = {
+            "@type": "neuroglancer_multilod_draco",
+            "vertex_quantization_bits": pe.VERTEX_QUANTIZATION_BITS,
+            "transform": pe.IDENTITY_TRANSFORM,
+            "lod_scale_multiplier": 1.0,
+            "sharding": json.loads(mesh_spec.to_json()),
+        }
+        files = {
+            "seg/info": json.dumps(info).encode(),
+            "seg/mesh/info": json.dumps(mesh_info).encode(),
+        }
+
+        shard_files = synthesize_shard_files(
+            mesh_spec,
+            {segment_id: fragments + manifest for segment_id, (fragments, manifest) in encoded.items()},
+            data_offset = {segment_id: len(manifest) for segment_id, (_, manifest) in encoded.items()},
+        )
+        for filename, data in shard_files.items():
+            files[f"seg/mesh/{filename}"] = data
+        return files
+
+    @property
+    def cloudpath(self):
+        host, port = self._server.server_address
+        return f"precomputed://http://{host}:{port}/seg"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+def _timed(function, *args, **kwargs):
+    start = time.time()
+    try:
+        function(*args, **kwargs)
+        error = False
+    except Exception:
+        error = True
+    return time.time() - start, error
+
+
+def benchmark_downloads(segment_ids, cloudpath, client, img_client, concurrency, output_dir):
+    """
+    Drives the download paths of 01_data_collection.py (mesh and synapses) and collect_regions.py
+    (segmentation cutouts) with concurrency parallel requests.
+
+    Returns
+    -------
+    pd.DataFrame
+        throughput in requests per second, p50/p95/p99 latency in seconds and error count per download path
+    """
+    data_collection = load_script(SCRIPT_DIR / "01_data_collection.py", "data_collection")
+    collect_regions = load_script(SCRIPT_DIR.parent / "scripts" / "collect_regions.py", "collect_regions")
+
+    paths = dict(
+        mesh = lambda segment_id: data_collection.download_mesh(segment_id, output_dir, cloudpath=cloudpath),
+        synapses = lambda segment_id: data_collection.collect_synapses(segment_id, output_dir, client=client),
+        segmentation = lambda segment_id: collect_regions.segmentation_overlap(img_client, img_client, [0, 0, 0], size=512, depth=64),
+    )
+
+    rows = []
+    for name, path in paths.items():
+        start = time.time()
+        with ThreadPoolExecutor(concurrency) as executor:
+            results = list(executor.map(lambda segment_id: _timed(path, segment_id), segment_ids))
+        wall_time = time.time() - start
+
+        latencies = np.array([latency for latency, _ in results])
+        rows.append(dict(
+            path = name,
+            concurrency = concurrency,
+            throughput = len(results) / wall_time,
+            p50 = np.percentile(latencies, 50),
+            p95 = np.percentile(latencies, 95),
+            p99 = np.percentile(latencies, 99),
+            errors = sum(error for _, error in results),
+        ))
+    return pd.DataFrame(rows)
+
+
+if __name__ == "__main__":
+    # Serves synthetic meshes, synapses, proofreading tables and segmentation cutouts with configurable latency,
+    # bandwidth and error rate, and benchmarks the download paths of 01_data_collection.py and collect_regions.py
+    # against them at several concurrency levels.
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n_segments", default=64, type=int, help="number of synthetic segments to download")
+    parser.add_argument("--latency", default=0.05, type=float, help="seconds added to every request")
+    parser.add_argument("--bandwidth_mb", default=50, type=float, help="MB per second per response, 0 for unlimited")
+    parser.add_argument("--error_rate", default=0.0, type=float, help="probability of a request failing")
+    parser.add_argument("--concurrency", nargs="*", default=[1, 4, 16], type=int, help="parallel requests to benchmark")
+    parser.add_argument("--subdivisions", default=5, type=int, help="subdivisions of the synthetic mesh spheres")
+    parser.add_argument("--output_csv", default=None, help="csv file the results are appended to")
+    args = parser.parse_args()
+
+    faults = FaultInjector(
+        latency = args.latency,
+        bandwidth = args.bandwidth_mb * 1024**2 if args.bandwidth_mb > 0 else None,
+        error_rate = args.error_rate,
+    )
+
+    segment_ids = list(range(1, args.n_segments + 1))
+    client = LocalCAVEclient(synapses=make_synapse_table(segment_ids), faults=faults)
+    img_client = LocalImageryClient(faults=faults)
+
+    results = []
+    with LocalPrecomputedServer(make_meshes(segment_ids, subdivisions=args.subdivisions), faults=faults) as server:
+        with tempfile.TemporaryDirectory() as output_dir:
+            for concurrency in args.concurrency:
+                results.append(benchmark_downloads(
+                    segment_ids,
+                    server.cloudpath,
+                    client,
+                    img_client,
+                    concurrency,
+                    output_dir + "/",
+                ))
+
+    results = pd.concat(results, ignore_index=True)
+    print(results.to_string(index=False))
+
+    if args.output_csv is not None:
+        results.to_csv(args.output_csv, index=False)
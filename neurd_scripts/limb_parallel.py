@@ -0,0 +1,300 @@
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+import numpy as np
+import argparse
+import hashlib
+import copy
+import time
+import os
+
+
+def build_neuron(mesh_decimated, segment_id, products):
+    """
+    Decomposes a neuron the way 04_decomposition.py does. Works on copies of the mesh and products
+    so that the same inputs can be decomposed several times.
+
+    Returns
+    -------
+    neuron.Neuron
+        Neuron with the decomposition products stored in its pipeline_products
+    """
+    from neurd import neuron
+
+    neuron_obj = neuron.Neuron(
+        mesh = mesh_decimated.copy(),
+        segment_id = segment_id,
+        pipeline_products = copy.deepcopy(products),
+        suppress_preprocessing_print=True,
+        suppress_output=True,
+    )
+
+    _ = neuron_obj.calculate_decomposition_products(
+        store_in_obj = True,
+    )
+
+    return neuron_obj
+
+
+@contextmanager
+def replaced_preprocess_limb(replacement):
+    """
+    Temporarily replaces neurd's per limb decomposition (preprocess_neuron.preprocess_limb), which
+    preprocess_neuron calls once for every limb cut off at the soma. Yields the original function.
+    """
+    from neurd import preprocess_neuron as pre
+
+    original = pre.preprocess_limb
+    pre.preprocess_limb = replacement
+    try:
+        yield original
+    finally:
+        pre.preprocess_limb = original
+
+
+def _limb_mesh(args, kwargs):
+    return kwargs["mesh"] if "mesh" in kwargs else args[0]
+
+
+def mesh_fingerprint(mesh):
+    """
+    Hash of the vertices and faces of a mesh, used to check that a limb is the one that was decomposed
+    """
+    digest = hashlib.sha1()
+    digest.update(np.ascontiguousarray(mesh.vertices).tobytes())
+    digest.update(np.ascontiguousarray(mesh.faces).tobytes())
+    return digest.hexdigest()
+
+
+def capture_limb_calls(mesh_decimated, segment_id, products):
+    """
+    Runs the decomposition with the per limb step replaced by a stub that only records its arguments.
+    The neuron built this way is meaningless and thrown away, only the limb meshes and parameters are
+    kept. Errors are only ignored once a limb was recorded, since the empty limbs returned by the stub
+    can break the code after the limb loop. An error before the first limb is raised.
+
+    Returns
+    -------
+    list
+        (args, kwargs) of every preprocess_limb call, in call order
+    """
+    calls = []
+
+    def record(*args, **kwargs):
+        calls.append((args, kwargs))
+        return dict()
+
+    with replaced_preprocess_limb(record):
+        try:
+            build_neuron(mesh_decimated, segment_id, products)
+        except Exception as e:
+            if len(calls) == 0:
+                raise
+            print(f"Ignoring error after recording {len(calls)} limbs: {e!r}")
+
+    if len(calls) == 0:
+        print("No limbs were recorded, every limb will be decomposed serially")
+
+    return calls
+
+
+def _preprocess_limb_worker(args, kwargs):
+    from neurd import preprocess_neuron as pre
+
+    start = time.time()
+    limb_correspondence = pre.preprocess_limb(*args, **kwargs)
+    return limb_correspondence, time.time() - start
+
+
+def decompose_limbs_parallel(mesh_decimated, segment_id, products, n_workers=None):
+    """
+    Decomposes a neuron with the limbs decomposed concurrently in worker processes.
+
+    The limbs are found with a first pass that records the inputs of every per limb decomposition,
+    which are then decomposed in a process pool, largest limb first. A second pass builds the neuron
+    the serial way, except that every per limb decomposition is answered with the precomputed result,
+    so limb objects, concept networks and products are assembled by the same code as in the serial path.
+    A limb that was not seen in the first pass is decomposed serially.
+
+    Parameters
+    ----------
+    mesh_decimated : trimesh.Trimesh
+        Decimated mesh of the segment
+    segment_id : int
+        ID of neuron segment
+    products : PipelineProducts
+        Products of the previous stages, as saved by 03_soma_identification.py
+    n_workers : int
+        Number of worker processes, defaults to the number of cores
+
+    Returns
+    -------
+    tuple
+        neuron.Neuron and a dict with the face count and runtime of every limb decomposed in parallel
+        and the number of limbs that fell back to serial decomposition
+    """
+    calls = capture_limb_calls(mesh_decimated, segment_id, products)
+    fingerprints = [mesh_fingerprint(_limb_mesh(*call)) for call in calls]
+    limb_faces = [len(_limb_mesh(*call).faces) for call in calls]
+
+    results = [None] * len(calls)
+    limb_runtime = [0.0] * len(calls)
+    if len(calls) > 0:
+        n_workers = min(n_workers or os.cpu_count(), len(calls))
+        with ProcessPoolExecutor(n_workers) as executor:
+            # largest limbs first so that a big limb does not start last and finish long after the rest
+            order = np.argsort(limb_faces, kind="stable")[::-1]
+            futures = {i: executor.submit(_preprocess_limb_worker, *calls[i]) for i in order}
+            for i, future in futures.items():
+                results[i], limb_runtime[i] = future.result()
+
+    n_replayed = 0
+    n_serial = 0
+
+    def replay(*args, **kwargs):
+        nonlocal n_replayed, n_serial
+        i = n_replayed
+        n_replayed += 1
+        if i < len(calls) and mesh_fingerprint(_limb_mesh(args, kwargs)) == fingerprints[i]:
+            return results[i]
+        n_serial += 1
+        print(f"Limb {i} was not decomposed in parallel, decomposing it serially")
+        return original(*args, **kwargs)
+
+    with replaced_preprocess_limb(replay) as original:
+        neuron_obj = build_neuron(mesh_decimated, segment_id, products)
+
+    return neuron_obj, dict(limb_faces=limb_faces, limb_runtime_s=limb_runtime, n_serial_limbs=n_serial)
+
+
+def compare_objects(obj, other, path="", ignore=("time",), visited=None):
+    """
+    Recursively compares two objects (dicts, sequences, arrays, meshes and the attributes of other
+    objects) and lists where they differ. Keys and attributes containing any of the ignore strings
+    are skipped, which by default excludes the runtimes neurd stores with its products.
+
+    Returns
+    -------
+    list
+        Paths of the differences
+    """
+    visited = set() if visited is None else visited
+    # pairs already compared, which also stops cycles between objects
+    if (id(obj), id(other)) in visited:
+        return []
+    visited.add((id(obj), id(other)))
+
+    if type(obj) != type(other):
+        return [f"{path}: {type(obj).__name__} != {type(other).__name__}"]
+
+    if hasattr(obj, "vertices") and hasattr(obj, "faces"):
+        same = np.array_equal(obj.vertices, other.vertices) and np.array_equal(obj.faces, other.faces)
+        return [] if same else [f"{path}: meshes differ"]
+
+    # pandas objects
+    if hasattr(obj, "equals"):
+        return [] if obj.equals(other) else [f"{path}: tables differ"]
+
+    if isinstance(obj, np.ndarray):
+        return [] if np.array_equal(obj, other, equal_nan=obj.dtype.kind == "f") else [f"{path}: arrays differ"]
+
+    if isinstance(obj, dict):
+        if set(obj.keys()) != set(other.keys()):
+            return [f"{path}: keys differ"]
+        differences = []
+        for key in obj:
+            if not any(s in str(key) for s in ignore):
+                differences += compare_objects(obj[key], other[key], f"{path}[{key!r}]", ignore, visited)
+        return differences
+
+    if isinstance(obj, (list, tuple)):
+        if len(obj) != len(other):
+            return [f"{path}: lengths {len(obj)} != {len(other)}"]
+        differences = []
+        for i, (item, other_item) in enumerate(zip(obj, other)):
+            differences += compare_objects(item, other_item, f"{path}[{i}]", ignore, visited)
+        return differences
+
+    if hasattr(obj, "__dict__"):
+        return compare_objects(vars(obj), vars(other), path, ignore, visited)
+
+    try:
+        same = obj == other or (obj != obj and other != other)
+    except Exception:
+        same = False
+    return [] if same else [f"{path}: {obj!r} != {other!r}"]
+
+
+def compare_neurons(neuron_obj, other):
+    """
+    Lists the differences between two decomposed neurons: limb and branch names, the skeleton, mesh
+    faces and width of every branch, and the pipeline products.
+
+    Returns
+    -------
+    list
+        Descriptions of the differences, empty if the neurons are identical
+    """
+    if neuron_obj.get_limb_names() != other.get_limb_names():
+        return ["limb names differ"]
+
+    differences = []
+    for limb_name in neuron_obj.get_limb_names():
+        limb, other_limb = neuron_obj[limb_name], other[limb_name]
+        if limb.get_branch_names() != other_limb.get_branch_names():
+            differences.append(f"{limb_name}: branch names differ")
+            continue
+        for branch_name in limb.get_branch_names():
+            branch, other_branch = limb[branch_name], other_limb[branch_name]
+            for attribute in ["skeleton", "mesh_face_idx", "width"]:
+                if not np.array_equal(getattr(branch, attribute), getattr(other_branch, attribute)):
+                    differences.append(f"{limb_name} branch {branch_name}: {attribute} differs")
+
+    differences += compare_objects(neuron_obj.pipeline_products, other.pipeline_products, "pipeline_products")
+    return differences
+
+
+if __name__ == "__main__":
+    # Decomposes a segment serially and with the limbs in parallel for several worker counts, checks
+    # that every parallel decomposition is identical to the serial one and reports the speedup.
+    # Needs the outputs of stages 02 and 03 in --base_dir.
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--segment_id", default=864691136361538530, help="id of segment to benchmark with")
+    parser.add_argument("--base_dir", default = "", help="base directory the results are saved in. Must end with /")
+    parser.add_argument("--n_workers", nargs="*", default=[1, 2, 4, 8], type=int, help="worker counts to time")
+    args = parser.parse_args()
+
+    from neurd.vdi_microns import volume_data_interface as vdi
+    from datasci_tools import system_utils as su
+
+    segment_id = int(args.segment_id)
+    base_dir = args.base_dir
+
+    mesh_decimated = vdi.fetch_segment_id_mesh(
+        mesh_filepath = f"{base_dir}{segment_id}_decimated.off"
+    )
+    products = su.load_object(
+        f"{base_dir}{segment_id}_products.pkl"
+    )
+
+    start = time.time()
+    serial = build_neuron(mesh_decimated, segment_id, products)
+    serial_time = time.time() - start
+    print(f"serial: {serial_time:.1f} s")
+
+    for n_workers in args.n_workers:
+        start = time.time()
+        neuron_obj, limb_stats = decompose_limbs_parallel(mesh_decimated, segment_id, products, n_workers=n_workers)
+        runtime = time.time() - start
+
+        differences = compare_neurons(serial, neuron_obj)
+        print(f"{n_workers} workers: {runtime:.1f} s, speedup {serial_time / runtime:.2f}, "
+              f"{limb_stats['n_serial_limbs']} limbs decomposed serially, "
+              f"{'identical' if len(differences) == 0 else f'{len(differences)} differences'}")
+        for difference in differences[:10]:
+            print(f"    {difference}")
+
+    # the largest limb bounds the speedup no matter how many workers there are
+    limb_runtime = limb_stats["limb_runtime_s"]
+    print(f"{len(limb_runtime)} limbs with {limb_stats['limb_faces']} faces, "
+          f"largest limb takes {max(limb_runtime, default=0):.1f} of {sum(limb_runtime):.1f} s of limb decomposition")
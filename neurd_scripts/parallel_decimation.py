@@ -0,0 +1,326 @@
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import argparse
+import time
+import os
+import shared_mesh as shm
+
+
+def partition_faces(mesh, n_partitions):
+    """
+    Splits the faces of a mesh into spatially compact partitions of about equal size by
+    recursively cutting the face centers at the median of their longest axis.
+
+    Parameters
+    ----------
+    mesh : trimesh.Trimesh
+        Mesh to partition
+    n_partitions : int
+        Number of partitions
+
+    Returns
+    -------
+    list
+        Face indices of every partition
+    """
+    centers = mesh.triangles_center
+    partitions = [np.arange(len(mesh.faces))]
+
+    while len(partitions) < n_partitions:
+        # always cut the largest partition so that sizes stay balanced
+        largest = int(np.argmax([len(p) for p in partitions]))
+        face_idx = partitions.pop(largest)
+
+        points = centers[face_idx]
+        axis = int(np.argmax(points.max(axis=0) - points.min(axis=0)))
+        order = np.argsort(points[:, axis], kind="stable")
+        half = len(order) // 2
+
+        partitions.append(face_idx[order[:half]])
+        partitions.append(face_idx[order[half:]])
+
+    return partitions
+
+
+def decimate_faces(vertices, faces, decimation_ratio, preserve_border=True, aggressiveness=7):
+    """
+    Decimates a mesh with quadric edge collapse (pyfqmr) to decimation_ratio of its faces.
+    With preserve_border the vertices on open borders are never moved or removed, which is what
+    keeps the cut between two partitions identical on both sides.
+
+    Returns
+    -------
+    tuple
+        vertices and faces of the decimated mesh
+    """
+    import pyfqmr
+
+    simplifier = pyfqmr.Simplify()
+    simplifier.setMesh(vertices, faces)
+    simplifier.simplify_mesh(
+        target_count = max(int(len(faces) * decimation_ratio), 4),
+        aggressiveness = aggressiveness,
+        preserve_border = preserve_border,
+        verbose = 0,
+    )
+    vertices, faces, _ = simplifier.getMesh()
+    return vertices, faces
+
+
+def decimate_mesh(mesh, decimation_ratio):
+    """
+    Decimates a whole mesh in one process with the same decimator and border handling as
+    decimate_parallel, i.e. pyfqmr with the open borders (holes) of the mesh locked. This is the
+    serial counterpart of decimate_parallel, the two only differ by the locked partition cuts.
+
+    Returns
+    -------
+    trimesh.Trimesh
+        Decimated mesh
+    """
+    import trimesh
+
+    vertices, faces = decimate_faces(mesh.vertices, mesh.faces, decimation_ratio, preserve_border=True)
+    return trimesh.Trimesh(vertices=vertices, faces=faces, process=False)
+
+
+def _decimate_partition(face_idx, decimation_ratio):
+    mesh = shm.worker_mesh()
+    partition_faces = mesh.faces[face_idx]
+
+    vertex_idx, partition_faces = np.unique(partition_faces, return_inverse=True)
+    partition_faces = partition_faces.reshape(-1, 3)
+
+    return decimate_faces(mesh.vertices[vertex_idx], partition_faces, decimation_ratio)
+
+
+def merge_partitions(partitions):
+    """
+    Concatenates decimated partitions and welds the vertices they share on their locked borders.
+
+    Parameters
+    ----------
+    partitions : list
+        (vertices, faces) of every decimated partition
+
+    Returns
+    -------
+    trimesh.Trimesh
+        Merged mesh
+    """
+    import trimesh
+
+    offsets = np.cumsum([0] + [len(v) for v, _ in partitions])
+    vertices = np.vstack([v for v, _ in partitions])
+    faces = np.vstack([f + offset for (_, f), offset in zip(partitions, offsets)])
+
+    # border vertices were never moved, so their copies on both sides of a cut are bit identical
+    unique_vertices, inverse = np.unique(vertices, axis=0, return_inverse=True)
+    faces = inverse.reshape(-1)[faces]
+
+    # drop faces that collapsed while welding
+    valid = (faces[:, 0] != faces[:, 1]) & (faces[:, 1] != faces[:, 2]) & (faces[:, 0] != faces[:, 2])
+
+    merged = trimesh.Trimesh(vertices=unique_vertices, faces=faces[valid], process=False)
+    merged.remove_unreferenced_vertices()
+    return merged
+
+
+def decimate_parallel(mesh, decimation_ratio, n_workers=None, n_partitions=None):
+    """
+    Decimates a mesh by decimating spatial partitions of it in parallel processes with their shared
+    borders locked, then merging the partitions and welding them at the borders.
+
+    pyfqmr can only lock all open borders of a partition, so the holes already in the mesh are
+    locked as well. decimate_mesh locks them the same way, which makes it the serial reference.
+
+    Parameters
+    ----------
+    mesh : trimesh.Trimesh
+        Mesh to decimate
+    decimation_ratio : float
+        Ratio of faces to keep
+    n_workers : int
+        Number of worker processes, defaults to the number of cores
+    n_partitions : int
+        Number of partitions, defaults to n_workers
+
+    Returns
+    -------
+    trimesh.Trimesh
+        Decimated mesh
+    """
+    if n_workers is None:
+        n_workers = os.cpu_count()
+    if n_partitions is None:
+        n_partitions = n_workers
+
+    partitions = partition_faces(mesh, n_partitions)
+
+    with shm.SharedMesh(mesh) as shared_mesh:
+        with ProcessPoolExecutor(n_workers, initializer=shm.init_worker, initargs=(shared_mesh.handle,)) as executor:
+            decimated = list(executor.map(_decimate_partition, partitions, [decimation_ratio] * len(partitions)))
+
+    return merge_partitions(decimated)
+
+
+def surface_distance(mesh, other_mesh, n_samples=100000):
+    """
+    Symmetric distance between the surfaces of two meshes, estimated from points sampled on both
+    and normalized by the bounding box diagonal of mesh.
+
+    Returns
+    -------
+    dict
+        mean and max of the normalized distance
+    """
+    from scipy.spatial import cKDTree
+    import trimesh
+
+    points = trimesh.sample.sample_surface(mesh, n_samples, seed=0)[0]
+    other_points = trimesh.sample.sample_surface(other_mesh, n_samples, seed=0)[0]
+
+    distances = np.concatenate([
+        cKDTree(other_points).query(points)[0],
+        cKDTree(points).query(other_points)[0],
+    ])
+    diagonal = np.linalg.norm(mesh.bounds[1] - mesh.bounds[0])
+
+    return dict(
+        mean = float(distances.mean() / diagonal),
+        max = float(distances.max() / diagonal),
+    )
+
+
+def triangle_quality(mesh):
+    """
+    Mean triangle quality, 1 for equilateral triangles and 0 for degenerate ones
+    (4 * sqrt(3) * area / sum of squared edge lengths).
+    """
+    triangles = mesh.triangles
+    edges = np.roll(triangles, -1, axis=1) - triangles
+    squared_lengths = (edges ** 2).sum(axis=(1, 2))
+    quality = 4 * np.sqrt(3) * mesh.area_faces / np.maximum(squared_lengths, 1e-12)
+    return float(quality.mean())
+
+
+def synthetic_mesh(subdivisions=8, n_holes=20, hole_size=50, seed=0):
+    """
+    Noisy icosphere with holes cut into it. Like the MICrONS meshes it has open borders, which
+    stay locked during decimation.
+
+    Parameters
+    ----------
+    subdivisions : int
+        Subdivisions of the icosphere
+    n_holes : int
+        Number of holes
+    hole_size : int
+        Number of faces removed around every hole center
+
+    Returns
+    -------
+    trimesh.Trimesh
+        Mesh with n_holes holes, or a closed mesh if n_holes is 0
+    """
+    from scipy.spatial import cKDTree
+    import trimesh
+
+    rng = np.random.default_rng(seed)
+    mesh = trimesh.creation.icosphere(subdivisions=subdivisions)
+    mesh.vertices += rng.normal(scale=1e-3, size=mesh.vertices.shape)
+
+    if n_holes > 0:
+        centers = mesh.triangles_center
+        hole_centers = rng.choice(len(centers), n_holes, replace=False)
+        _, removed = cKDTree(centers).query(centers[hole_centers], k=hole_size)
+        keep = np.ones(len(mesh.faces), dtype=bool)
+        keep[removed.ravel()] = False
+        mesh = trimesh.Trimesh(vertices=mesh.vertices, faces=mesh.faces[keep], process=False)
+        mesh.remove_unreferenced_vertices()
+
+    return mesh
+
+
+def boundary_edges(mesh):
+    """
+    Edges used by only one face, as sorted vertex index pairs
+    """
+    edges = np.sort(mesh.edges, axis=1)
+    unique_edges, counts = np.unique(edges, axis=0, return_counts=True)
+    return unique_edges[counts == 1]
+
+
+def compare_decimations(mesh, decimated, reference):
+    """
+    Compares a parallel decimation against a reference decimation of the same mesh.
+
+    Returns
+    -------
+    dict
+        face counts, triangle quality and surface distance to the original mesh of both decimations
+    """
+    return dict(
+        faces = len(decimated.faces),
+        reference_faces = len(reference.faces),
+        quality = triangle_quality(decimated),
+        reference_quality = triangle_quality(reference),
+        distance = surface_distance(mesh, decimated),
+        reference_distance = surface_distance(mesh, reference),
+    )
+
+
+if __name__ == "__main__":
+    # Compares parallel fragment decimation against decimating the whole mesh with the same decimator
+    # (pyfqmr, holes locked) and, if mesh_tools is installed, against tu.decimate which 02_decimation.py
+    # uses by default. Reports how wall time scales with the number of workers. Uses the raw mesh of
+    # --segment_id if it exists in --base_dir, otherwise a synthetic noisy sphere with holes.
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--segment_id", default=864691136361538530, help="id of segment to benchmark with")
+    parser.add_argument("--base_dir", default = "", help="base directory the results are saved in. Must end with /")
+    parser.add_argument("--decimation_ratio", default=0.062, type=float, help="ratio by which to decimate mesh")
+    parser.add_argument("--subdivisions", default=8, type=int, help="subdivisions of the synthetic sphere")
+    parser.add_argument("--n_holes", default=20, type=int, help="holes cut into the synthetic sphere")
+    parser.add_argument("--n_workers", nargs="*", default=[1, 2, 4, 8], type=int, help="worker counts to time")
+    args = parser.parse_args()
+
+    import trimesh
+
+    mesh_filepath = f"{args.base_dir}{args.segment_id}.off"
+    if os.path.exists(mesh_filepath):
+        mesh = trimesh.load(mesh_filepath, process=False)
+    else:
+        mesh = synthetic_mesh(subdivisions=args.subdivisions, n_holes=args.n_holes)
+
+    print(f"Mesh with {len(mesh.faces)} faces and {len(boundary_edges(mesh))} boundary edges")
+
+    references = dict()
+
+    start = time.time()
+    references["whole mesh pyfqmr"] = decimate_mesh(mesh, args.decimation_ratio)
+    print(f"whole mesh pyfqmr: {time.time() - start:.2f} s")
+
+    try:
+        from mesh_tools import trimesh_utils as tu
+    except ImportError:
+        print("mesh_tools is not installed, skipping the comparison against tu.decimate")
+    else:
+        start = time.time()
+        references["tu.decimate"] = tu.decimate(mesh, decimation_ratio=args.decimation_ratio)
+        print(f"tu.decimate: {time.time() - start:.2f} s")
+
+    for n_workers in args.n_workers:
+        start = time.time()
+        decimated = decimate_parallel(mesh, args.decimation_ratio, n_workers=n_workers)
+        print(f"{n_workers} workers: {time.time() - start:.2f} s")
+
+    print(f"parallel: {len(boundary_edges(decimated))} boundary edges")
+    for name, reference in references.items():
+        comparison = compare_decimations(mesh, decimated, reference)
+        print(f"against {name}:")
+        print(f"    faces: {comparison['faces']} parallel, {comparison['reference_faces']} {name}")
+        print(f"    triangle quality: {comparison['quality']:.3f} parallel, {comparison['reference_quality']:.3f} {name}")
+        print(f"    surface distance (mean/max of bbox diagonal): "
+              f"{comparison['distance']['mean']:.2e}/{comparison['distance']['max']:.2e} parallel, "
+              f"{comparison['reference_distance']['mean']:.2e}/{comparison['reference_distance']['max']:.2e} {name}")
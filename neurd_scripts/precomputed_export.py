@@ -0,0 +1,529 @@
+from concurrent.futures import ProcessPoolExecutor
+from collections import defaultdict
+from pathlib import Path
+import numpy as np
+import argparse
+import json
+import re
+
+
+# compartment vertex attribute of the exported skeletons
+COMPARTMENTS = dict(
+    unknown = 0,
+    dendrite = 1,
+    axon = 2,
+)
+
+IDENTITY_TRANSFORM = [1, 0, 0, 0, 0, 1, 0, 0, 0, 0, 1, 0]
+
+# neuroglancer supports 10 or 16 bit vertex positions inside a fragment. 10 bits over a whole neuron
+# (~300 um) is a 300 nm step, coarser than thin axons, so fragments are stored with 16 bits
+VERTEX_QUANTIZATION_BITS = 16
+
+# largest fragment of the full resolution level in physical units (nm), larger neurons are split
+# into a grid of fragments so the quantization step stays small
+MAX_CHUNK_SIZE = 2 ** 17
+
+
+# minnie65 segment ids keep their chunk layer in the bits below 60, so the top 4 bits are free to
+# tell the splits of a segment apart
+SPLIT_SHIFT = 60
+MAX_SPLITS = 1 << (64 - SPLIT_SHIFT)
+
+
+def neuron_label(segment_id, split):
+    """
+    Stable uint64 label of a split of a segment. Split 0 keeps the segment id as its label, split i
+    sets the top 4 bits to i, which no segment id uses. The label of a neuron therefore never changes
+    between exports and links to it stay valid.
+    """
+    if segment_id >> SPLIT_SHIFT != 0:
+        raise ValueError(f"Segment id {segment_id} uses the top {64 - SPLIT_SHIFT} bits reserved for splits")
+    if not 0 <= split < MAX_SPLITS:
+        raise ValueError(f"Split {split} of segment {segment_id} does not fit into a label, at most {MAX_SPLITS} splits are supported")
+    return (split << SPLIT_SHIFT) | segment_id
+
+
+def find_proofread_neurons(base_dir="", pattern="*_split_*_proofread.pbz2"):
+    """
+    Finds the proofread neurons saved by 06_proofreading.py and assigns every one a label derived
+    from its segment id and split (see neuron_label), so labels stay the same when neurons are added.
+
+    Parameters
+    ----------
+    base_dir : str
+        Directory the pipeline results are saved in. Must end with /
+    pattern : str
+        Glob pattern of the proofread neuron files
+
+    Returns
+    -------
+    list
+        dicts with label, segment_id, split and filepath of every neuron
+    """
+    neurons = []
+    for filepath in sorted(Path(base_dir or ".").glob(pattern)):
+        match = re.match(r"(\d+)_split_(\d+)_", filepath.name)
+        if match is None:
+            continue
+        segment_id, split = int(match.group(1)), int(match.group(2))
+        neurons.append(dict(
+            label = neuron_label(segment_id, split),
+            segment_id = segment_id,
+            split = split,
+            filepath = str(filepath),
+        ))
+    return neurons
+
+
+def load_proofread_neuron(segment_id, filepath, base_dir=""):
+    """
+    Loads a proofread neuron object together with the decimated mesh it refers to.
+    """
+    from neurd.vdi_microns import volume_data_interface as vdi
+    from neurd import neuron_utils as nru
+
+    mesh_decimated = vdi.fetch_segment_id_mesh(
+        mesh_filepath = f"{base_dir}{segment_id}_decimated.off"
+    )
+    return nru.decompress_neuron(
+        filepath = filepath,
+        original_mesh = mesh_decimated,
+        suppress_output = True,
+    )
+
+
+def neuron_skeleton(neuron_obj):
+    """
+    Collects the skeleton of every branch of a neuron into one graph with the compartment
+    (axon or dendrite) of every vertex.
+
+    Returns
+    -------
+    tuple
+        float32 vertices (n, 3), uint32 edges (m, 2) and uint8 compartment of every vertex (n,)
+    """
+    segments = []
+    segment_compartments = []
+    for limb_name in neuron_obj.get_limb_names():
+        limb = neuron_obj[limb_name]
+        for branch_name in limb.get_branch_names():
+            branch = limb[branch_name]
+            branch_segments = np.asarray(branch.skeleton).reshape(-1, 2, 3)
+            compartment = COMPARTMENTS["axon"] if "axon" in branch.labels else COMPARTMENTS["dendrite"]
+
+            segments.append(branch_segments)
+            segment_compartments.append(np.full(len(branch_segments), compartment, dtype=np.uint8))
+
+    if len(segments) == 0:
+        return np.zeros((0, 3), dtype=np.float32), np.zeros((0, 2), dtype=np.uint32), np.zeros(0, dtype=np.uint8)
+
+    segments = np.concatenate(segments)
+    segment_compartments = np.concatenate(segment_compartments)
+
+    # branches share their end points, so identical coordinates become one vertex
+    vertices, edges = np.unique(segments.reshape(-1, 3), axis=0, return_inverse=True)
+    edges = edges.reshape(-1, 2)
+    non_degenerate = edges[:, 0] != edges[:, 1]
+    edges, segment_compartments = edges[non_degenerate], segment_compartments[non_degenerate]
+
+    # vertices where axon and dendrite branches meet are labeled axon
+    compartment = np.zeros(len(vertices), dtype=np.uint8)
+    np.maximum.at(compartment, edges.reshape(-1), np.repeat(segment_compartments, 2))
+
+    return vertices.astype(np.float32), edges.astype(np.uint32), compartment
+
+
+def encode_skeleton(vertices, edges, compartment):
+    """
+    Encodes a skeleton in the neuroglancer precomputed skeleton format with compartment as vertex attribute.
+    """
+    return b"".join([
+        np.array([len(vertices), len(edges)], dtype="<u4").tobytes(),
+        np.asarray(vertices, dtype="<f4").tobytes(),
+        np.asarray(edges, dtype="<u4").tobytes(),
+        np.asarray(compartment, dtype="u1").tobytes(),
+    ])
+
+
+def mesh_lods(vertices, faces, n_lods=3, lod_ratio=0.25, min_faces=100):
+    """
+    Levels of detail of a mesh, every level keeps lod_ratio of the faces of the previous one.
+
+    Returns
+    -------
+    list
+        (vertices, faces) of every level of detail, level 0 is the full mesh
+    """
+    import parallel_decimation as pdec
+
+    lods = [(np.asarray(vertices, dtype=np.float64), np.asarray(faces, dtype=np.int64))]
+    for _ in range(1, n_lods):
+        previous_vertices, previous_faces = lods[-1]
+        if len(previous_faces) * lod_ratio < min_faces:
+            break
+        lods.append(pdec.decimate_faces(previous_vertices, previous_faces, lod_ratio, preserve_border=False))
+    return lods
+
+
+def split_into_chunks(vertices, faces, grid_origin, chunk_size):
+    """
+    Cuts a mesh along the planes of a grid of chunks. Faces crossing a plane are split, so every
+    piece lies inside its chunk.
+
+    Parameters
+    ----------
+    vertices : np.ndarray
+        Vertices of the mesh
+    faces : np.ndarray
+        Faces of the mesh
+    grid_origin : np.ndarray
+        Corner of the grid, below all vertices
+    chunk_size : np.ndarray
+        Size of a chunk along every axis
+
+    Returns
+    -------
+    dict
+        (vertices, faces) of the piece in every non-empty chunk, keyed by the grid position of the chunk
+    """
+    from trimesh.intersections import slice_faces_plane
+
+    n_chunks = np.maximum(np.ceil((vertices.max(axis=0) - grid_origin) / chunk_size).astype(int), 1)
+
+    pieces = {(): (np.asarray(vertices, dtype=np.float64), np.asarray(faces, dtype=np.int64))}
+    for axis in range(3):
+        normal = np.eye(3)[axis]
+        axis_pieces = dict()
+        for position, (piece_vertices, piece_faces) in pieces.items():
+            for i in range(n_chunks[axis]):
+                chunk_vertices, chunk_faces = piece_vertices, piece_faces
+                # keep the side above the lower plane of the chunk, then the side below its upper plane
+                if i > 0:
+                    plane = grid_origin + normal * i * chunk_size[axis]
+                    chunk_vertices, chunk_faces = slice_faces_plane(chunk_vertices, chunk_faces, normal, plane)[:2]
+                if i < n_chunks[axis] - 1 and len(chunk_faces) > 0:
+                    plane = grid_origin + normal * (i + 1) * chunk_size[axis]
+                    chunk_vertices, chunk_faces = slice_faces_plane(chunk_vertices, chunk_faces, -normal, plane)[:2]
+                if len(chunk_faces) > 0:
+                    axis_pieces[position + (i,)] = (chunk_vertices, chunk_faces)
+        pieces = axis_pieces
+
+    chunks = dict()
+    for position, (piece_vertices, piece_faces) in pieces.items():
+        vertex_idx, piece_faces = np.unique(piece_faces, return_inverse=True)
+        chunks[position] = (piece_vertices[vertex_idx], piece_faces.reshape(-1, 3))
+    return chunks
+
+
+def zorder_key(position):
+    """
+    Position of a grid cell along the Z-order curve, the order neuroglancer expects fragments in
+    """
+    key = 0
+    for bit in range(21):
+        for axis, coordinate in enumerate(position):
+            key |= ((int(coordinate) >> bit) & 1) << (3 * bit + axis)
+    return key
+
+
+def encode_multilod_draco(lods, vertex_quantization_bits=VERTEX_QUANTIZATION_BITS, max_chunk_size=MAX_CHUNK_SIZE):
+    """
+    Encodes levels of detail of a mesh in the neuroglancer multi-resolution (multilod draco) format.
+
+    Level 0 is cut into a grid of fragments of at most max_chunk_size, every further level doubles
+    the fragment size, so small neurons have a single fragment per level. Vertex positions are
+    quantized to vertex_quantization_bits inside their fragment.
+
+    Returns
+    -------
+    tuple
+        fragment data of all levels and the manifest, which follows the fragments in a sharded file
+    """
+    import DracoPy
+
+    all_vertices = np.concatenate([lod_vertices for lod_vertices, _ in lods])
+    grid_origin = all_vertices.min(axis=0)
+    extent = np.maximum(all_vertices.max(axis=0) - grid_origin, 1e-3)
+    chunk_shape = np.minimum(extent, max_chunk_size)
+    max_quantized = 2 ** vertex_quantization_bits - 1
+
+    fragments = []
+    lod_positions = []
+    lod_sizes = []
+    for lod, (lod_vertices, lod_faces) in enumerate(lods):
+        lod_chunk_shape = chunk_shape * 2 ** lod
+        chunks = split_into_chunks(np.asarray(lod_vertices), np.asarray(lod_faces), grid_origin, lod_chunk_shape)
+        positions = sorted(chunks, key=zorder_key)
+
+        sizes = []
+        for position in positions:
+            chunk_vertices, chunk_faces = chunks[position]
+            # positions inside the fragment's chunk, scaled to the quantization range
+            stored_vertices = (chunk_vertices - grid_origin - np.array(position) * lod_chunk_shape) / lod_chunk_shape * max_quantized
+            fragment = DracoPy.encode(
+                np.clip(stored_vertices, 0, max_quantized).astype(np.float32),
+                np.asarray(chunk_faces, dtype=np.uint32),
+                quantization_bits = vertex_quantization_bits,
+                quantization_range = max_quantized,
+                quantization_origin = np.zeros(3),
+                compression_level = 7,
+            )
+            fragments.append(fragment)
+            sizes.append(len(fragment))
+
+        lod_positions.append(np.array(positions, dtype="<u4").reshape(-1, 3))
+        lod_sizes.append(np.array(sizes, dtype="<u4"))
+
+    n_lods = len(lods)
+    manifest = b"".join([
+        chunk_shape.astype("<f4").tobytes(),
+        grid_origin.astype("<f4").tobytes(),
+        np.array([n_lods], dtype="<u4").tobytes(),
+        np.array([2 ** lod for lod in range(n_lods)], dtype="<f4").tobytes(),
+        np.zeros((n_lods, 3), dtype="<f4").tobytes(),
+        np.array([len(sizes) for sizes in lod_sizes], dtype="<u4").tobytes(),
+    ] + [
+        # fragment positions (in chunks of this level) as x, y and z rows, followed by the fragment sizes
+        np.ascontiguousarray(positions.T).tobytes() + sizes.tobytes()
+        for positions, sizes in zip(lod_positions, lod_sizes)
+    ])
+    return b"".join(fragments), manifest
+
+
+def encode_legacy_mesh(vertices, faces):
+    """
+    Encodes a mesh as a single fragment of the neuroglancer legacy (single resolution) mesh format.
+    """
+    return b"".join([
+        np.array([len(vertices)], dtype="<u4").tobytes(),
+        np.asarray(vertices, dtype="<f4").tobytes(),
+        np.asarray(faces, dtype="<u4").tobytes(),
+    ])
+
+
+def encode_object(mesh, skeleton, mesh_encoding="draco", n_lods=3, vertex_quantization_bits=VERTEX_QUANTIZATION_BITS):
+    """
+    Encodes the mesh and skeleton of one neuron.
+
+    Parameters
+    ----------
+    mesh : trimesh.Trimesh
+        Mesh of the neuron
+    skeleton : tuple
+        vertices, edges and compartment as returned by neuron_skeleton
+    mesh_encoding : str
+        draco for multi-resolution sharded meshes, raw for legacy single resolution meshes
+    n_lods : int
+        Number of levels of detail of draco meshes
+    vertex_quantization_bits : int
+        Bits of the vertex positions of draco meshes, 10 or 16
+
+    Returns
+    -------
+    dict
+        mesh, mesh manifest (draco only) and skeleton as bytes
+    """
+    if mesh_encoding == "draco":
+        mesh_data, manifest = encode_multilod_draco(
+            mesh_lods(mesh.vertices, mesh.faces, n_lods=n_lods),
+            vertex_quantization_bits = vertex_quantization_bits,
+        )
+    else:
+        mesh_data, manifest = encode_legacy_mesh(mesh.vertices, mesh.faces), None
+
+    return dict(
+        mesh = mesh_data,
+        manifest = manifest,
+        skeleton = encode_skeleton(*skeleton),
+    )
+
+
+def _export_neuron(neuron, base_dir, mesh_encoding, n_lods, vertex_quantization_bits):
+    neuron_obj = load_proofread_neuron(neuron["segment_id"], neuron["filepath"], base_dir)
+    encoded = encode_object(neuron_obj.mesh, neuron_skeleton(neuron_obj), mesh_encoding, n_lods, vertex_quantization_bits)
+    encoded["label"] = neuron["label"]
+    return encoded
+
+
+def sharding_spec(n_objects, objects_per_shard=512, objects_per_minishard=32, data_encoding="raw"):
+    """
+    Sharding specification that spreads n_objects hashed labels over shards of about objects_per_shard objects.
+    """
+    from cloudvolume.datasource.precomputed.sharding import ShardingSpecification
+
+    shard_bits = int(np.ceil(np.log2(max(n_objects / objects_per_shard, 1))))
+    minishard_bits = int(np.ceil(np.log2(max(objects_per_shard / objects_per_minishard, 1))))
+
+    return ShardingSpecification(
+        type = "neuroglancer_uint64_sharded_v1",
+        preshift_bits = 0,
+        hash = "murmurhash3_x86_128",
+        minishard_bits = minishard_bits,
+        shard_bits = shard_bits,
+        minishard_index_encoding = "gzip",
+        data_encoding = data_encoding,
+    )
+
+
+def write_info(output_dir, neurons, mesh_spec, skeleton_spec, mesh_encoding, vertex_quantization_bits=VERTEX_QUANTIZATION_BITS):
+    """
+    Writes the info files of the mesh and skeleton sources and the segment properties naming every label.
+    """
+    output_dir = Path(output_dir)
+    for directory in ["mesh", "skeletons", "segment_properties"]:
+        (output_dir / directory).mkdir(parents=True, exist_ok=True)
+
+    if mesh_encoding == "draco":
+        mesh_info = {
+            "@type": "neuroglancer_multilod_draco",
+            "vertex_quantization_bits": vertex_quantization_bits,
+            "transform": IDENTITY_TRANSFORM,
+            "lod_scale_multiplier": 1.0,
+            "sharding": json.loads(mesh_spec.to_json()),
+        }
+    else:
+        mesh_info = {"@type": "neuroglancer_legacy_mesh"}
+
+    skeleton_info = {
+        "@type": "neuroglancer_skeletons",
+        "transform": IDENTITY_TRANSFORM,
+        "vertex_attributes": [
+            {"id": "compartment", "data_type": "uint8", "num_components": 1},
+        ],
+        "sharding": json.loads(skeleton_spec.to_json()),
+        "segment_properties": "../segment_properties",
+    }
+
+    segment_properties = {
+        "@type": "neuroglancer_segment_properties",
+        "inline": {
+            "ids": [str(neuron["label"]) for neuron in neurons],
+            "properties": [{
+                "id": "label",
+                "type": "label",
+                "values": [f"{neuron['segment_id']}_split_{neuron['split']}" for neuron in neurons],
+            }],
+        },
+    }
+
+    for directory, info in [("mesh", mesh_info), ("skeletons", skeleton_info), ("segment_properties", segment_properties)]:
+        with open(output_dir / directory / "info", "w") as f:
+            json.dump(info, f)
+
+
+def export_precomputed(
+    neurons,
+    output_dir,
+    base_dir="",
+    n_workers=None,
+    mesh_encoding="draco",
+    n_lods=3,
+    objects_per_shard=512,
+    vertex_quantization_bits=VERTEX_QUANTIZATION_BITS,
+    ):
+    """
+    Exports the meshes and skeletons of proofread neurons into a sharded precomputed layout.
+
+    Neurons are grouped by the shard their label hashes to and one shard is built at a time, so only
+    the encoded objects of a single shard are ever held in memory. The neurons of a shard are loaded
+    and encoded in parallel worker processes.
+
+    Parameters
+    ----------
+    neurons : list
+        Neurons as returned by find_proofread_neurons
+    output_dir : str
+        Directory the precomputed layout is written to
+    base_dir : str
+        Directory the pipeline results are saved in. Must end with /
+    n_workers : int
+        Number of worker processes, defaults to the number of cores
+    mesh_encoding : str
+        draco for sharded multi-resolution meshes, raw for unsharded legacy single resolution meshes
+    n_lods : int
+        Number of levels of detail of draco meshes
+    objects_per_shard : int
+        Approximate number of neurons per shard file, bounds the memory used
+    vertex_quantization_bits : int
+        Bits of the vertex positions of draco meshes, 10 or 16
+    """
+    from cloudvolume.datasource.precomputed.sharding import synthesize_shard_files
+
+    output_dir = Path(output_dir)
+    # multi-resolution mesh fragments have to be stored raw, only the manifest index can be compressed
+    mesh_spec = sharding_spec(len(neurons), objects_per_shard, data_encoding="raw")
+    skeleton_spec = sharding_spec(len(neurons), objects_per_shard, data_encoding="gzip")
+    write_info(output_dir, neurons, mesh_spec, skeleton_spec, mesh_encoding, vertex_quantization_bits)
+
+    with open(output_dir / "labels.csv", "w") as f:
+        f.write("label,segment_id,split,filepath\n")
+        for neuron in neurons:
+            f.write(f"{neuron['label']},{neuron['segment_id']},{neuron['split']},{neuron['filepath']}\n")
+
+    # mesh and skeleton specs only differ in encoding, so a label lands in the same shard in both
+    shards = defaultdict(list)
+    for neuron in neurons:
+        shards[skeleton_spec.compute_shard_location(neuron["label"]).shard_number].append(neuron)
+
+    with ProcessPoolExecutor(n_workers) as executor:
+        for i, (shard_number, shard_neurons) in enumerate(sorted(shards.items())):
+            encoded = list(executor.map(
+                _export_neuron,
+                shard_neurons,
+                [base_dir] * len(shard_neurons),
+                [mesh_encoding] * len(shard_neurons),
+                [n_lods] * len(shard_neurons),
+                [vertex_quantization_bits] * len(shard_neurons),
+            ))
+
+            skeleton_files = synthesize_shard_files(skeleton_spec, {e["label"]: e["skeleton"] for e in encoded})
+            if mesh_encoding == "draco":
+                mesh_files = synthesize_shard_files(
+                    mesh_spec,
+                    {e["label"]: e["mesh"] + e["manifest"] for e in encoded},
+                    # the index of every label points at its manifest, which follows the fragments
+                    data_offset = {e["label"]: len(e["manifest"]) for e in encoded},
+                )
+            else:
+                mesh_files = dict()
+                for e in encoded:
+                    mesh_files[f"{e['label']}:0:1"] = e["mesh"]
+                    mesh_files[f"{e['label']}:0"] = json.dumps({"fragments": [f"{e['label']}:0:1"]}).encode()
+
+            for directory, files in [("skeletons", skeleton_files), ("mesh", mesh_files)]:
+                for filename, data in files.items():
+                    with open(output_dir / directory / filename, "wb") as f:
+                        f.write(data)
+
+            print(f"Wrote shard {shard_number} ({i + 1}/{len(shards)}) with {len(encoded)} neurons")
+
+
+if __name__ == "__main__":
+    # Exports all proofread neurons in --base_dir to a sharded precomputed layout in --output_dir for
+    # serving meshes and skeletons (with axon/dendrite compartment labels) to neuroglancer
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--base_dir", default = "", help="base directory the results are saved in. Must end with /")
+    parser.add_argument("--output_dir", default="precomputed", help="directory to write the precomputed layout to")
+    parser.add_argument("--pattern", default="*_split_*_proofread.pbz2", help="glob pattern of proofread neurons")
+    parser.add_argument("--mesh_encoding", default="draco", choices=["draco", "raw"], help="draco: sharded multi-resolution, raw: legacy single resolution")
+    parser.add_argument("--n_lods", default=3, type=int, help="levels of detail of draco meshes")
+    parser.add_argument("--vertex_quantization_bits", default=VERTEX_QUANTIZATION_BITS, type=int, choices=[10, 16], help="bits of the vertex positions of draco meshes")
+    parser.add_argument("--n_workers", default=None, type=int, help="number of worker processes")
+    parser.add_argument("--objects_per_shard", default=512, type=int, help="approximate number of neurons per shard")
+    args = parser.parse_args()
+
+    neurons = find_proofread_neurons(args.base_dir, args.pattern)
+    print(f"Exporting {len(neurons)} proofread neurons to {args.output_dir}")
+
+    export_precomputed(
+        neurons,
+        args.output_dir,
+        base_dir = args.base_dir,
+        n_workers = args.n_workers,
+        mesh_encoding = args.mesh_encoding,
+        n_lods = args.n_lods,
+        vertex_quantization_bits = args.vertex_quantization_bits,
+        objects_per_shard = args.objects_per_shard,
+    )
@@ -0,0 +1,11 @@
+import importlib.util
+
+
+def load_script(path, name):
+    """
+    Imports a script whose filename is not a valid module name (e.g. 01_data_collection.py) without running its main block.
+    """
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
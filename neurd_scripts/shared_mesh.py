@@ -0,0 +1,208 @@
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import numpy as np
+import tempfile
+import argparse
+import weakref
+import pickle
+import shutil
+import time
+import os
+
+
+# mesh attached by init_worker, one per worker process
+_worker_mesh = None
+
+
+def _shared_directory():
+    """
+    Directory the shared arrays are written to. /dev/shm is memory backed on linux, so the arrays
+    never touch the disk there.
+    """
+    if os.path.isdir("/dev/shm"):
+        return "/dev/shm"
+    return tempfile.gettempdir()
+
+
+class SharedMesh:
+    """
+    Holds the vertices and faces of a trimesh in memory-mapped files so that worker processes
+    can attach to them without the mesh being pickled and copied into every worker.
+
+    The process that creates the SharedMesh owns the files and removes them on cleanup,
+    when leaving a with block or at the latest when the object is garbage collected.
+
+    Example
+    -------
+    with SharedMesh(mesh_decimated) as shared_mesh:
+        with ProcessPoolExecutor(initializer=init_worker, initargs=(shared_mesh.handle,)) as executor:
+            ...
+    """
+    def __init__(self, mesh, directory=None):
+        if directory is None:
+            directory = _shared_directory()
+
+        self.directory = tempfile.mkdtemp(prefix="shared_mesh_", dir=directory)
+        self._finalizer = weakref.finalize(self, shutil.rmtree, self.directory, ignore_errors=True)
+
+        # trimesh stores vertices as float64 and faces as int64, matching dtypes avoid a copy on attach
+        vertices = np.ascontiguousarray(mesh.vertices, dtype=np.float64)
+        faces = np.ascontiguousarray(mesh.faces, dtype=np.int64)
+
+        self.handle = dict(
+            vertices_path = os.path.join(self.directory, "vertices.npy"),
+            faces_path = os.path.join(self.directory, "faces.npy"),
+        )
+        np.save(self.handle["vertices_path"], vertices)
+        np.save(self.handle["faces_path"], faces)
+
+    def cleanup(self):
+        """
+        Removes the shared files. Workers that are still attached keep their mapping until they exit.
+        """
+        self._finalizer()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.cleanup()
+
+
+def attach_mesh(handle):
+    """
+    Wraps the arrays of a SharedMesh as a trimesh without copying them.
+
+    The arrays are mapped copy-on-write, so a worker modifying the mesh only copies the pages it
+    writes to and never changes the mesh seen by the other workers.
+
+    Parameters
+    ----------
+    handle : dict
+        The handle attribute of a SharedMesh
+
+    Returns
+    -------
+    trimesh.Trimesh
+        Mesh backed by the shared arrays
+    """
+    import trimesh
+
+    vertices = np.load(handle["vertices_path"], mmap_mode="c")
+    faces = np.load(handle["faces_path"], mmap_mode="c")
+
+    return trimesh.Trimesh(
+        vertices = vertices,
+        faces = faces,
+        process = False,
+    )
+
+
+def init_worker(handle):
+    """
+    Initializer for process pools, attaches the shared mesh once per worker.
+    """
+    global _worker_mesh
+    _worker_mesh = attach_mesh(handle)
+
+
+def worker_mesh():
+    """
+    Returns the mesh attached by init_worker in the current worker process.
+    """
+    if _worker_mesh is None:
+        raise Exception("No shared mesh attached, the pool has to be started with initializer=init_worker")
+    return _worker_mesh
+
+
+def _private_memory_mb():
+    """
+    Memory of the current process that is not shared with other processes (RssAnon on linux).
+    """
+    with open("/proc/self/status", "r") as f:
+        for line in f:
+            if line.startswith("RssAnon:"):
+                return int(line.split()[1]) / 1024
+    return 0
+
+
+def _pickled_task(mesh):
+    area = mesh.area
+    return area, _private_memory_mb()
+
+
+def _shared_task(_):
+    area = worker_mesh().area
+    return area, _private_memory_mb()
+
+
+def benchmark_handoff(mesh, n_workers=4, n_tasks=8):
+    """
+    Compares handing a mesh to process pool workers by pickling against attaching to a SharedMesh.
+
+    Parameters
+    ----------
+    mesh : trimesh.Trimesh
+        Mesh to hand to the workers
+    n_workers : int
+        Number of worker processes
+    n_tasks : int
+        Number of tasks submitted to the pool, every task touches the whole mesh
+
+    Returns
+    -------
+    dict
+        Wall time and mean private memory per worker of both handoffs
+    """
+    # spawn so that workers do not inherit the mesh of the parent through fork
+    context = multiprocessing.get_context("spawn")
+    results = dict()
+
+    start = time.time()
+    with ProcessPoolExecutor(n_workers, mp_context=context) as executor:
+        pickled = list(executor.map(_pickled_task, [mesh] * n_tasks))
+    results["pickled"] = dict(
+        time_s = time.time() - start,
+        worker_private_memory_mb = float(np.mean([m for _, m in pickled])),
+    )
+
+    start = time.time()
+    with SharedMesh(mesh) as shared_mesh:
+        with ProcessPoolExecutor(n_workers, mp_context=context, initializer=init_worker, initargs=(shared_mesh.handle,)) as executor:
+            shared = list(executor.map(_shared_task, range(n_tasks)))
+    results["shared"] = dict(
+        time_s = time.time() - start,
+        worker_private_memory_mb = float(np.mean([m for _, m in shared])),
+    )
+
+    if not np.allclose([a for a, _ in pickled], [a for a, _ in shared]):
+        raise Exception("Shared mesh does not match the pickled mesh")
+
+    return results
+
+
+if __name__ == "__main__":
+    # Benchmarks pickling a mesh into process pool workers against attaching to a shared mesh.
+    # Uses the decimated mesh of --segment_id if it exists in --base_dir, otherwise a synthetic sphere.
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--segment_id", default=864691136361538530, help="id of segment to benchmark with")
+    parser.add_argument("--base_dir", default = "", help="base directory the results are saved in. Must end with /")
+    parser.add_argument("--subdivisions", default=8, type=int, help="subdivisions of the synthetic sphere")
+    parser.add_argument("--n_workers", default=4, type=int)
+    parser.add_argument("--n_tasks", default=8, type=int)
+    args = parser.parse_args()
+
+    import trimesh
+
+    mesh_filepath = f"{args.base_dir}{args.segment_id}_decimated.off"
+    if os.path.exists(mesh_filepath):
+        mesh = trimesh.load(mesh_filepath, process=False)
+    else:
+        mesh = trimesh.creation.icosphere(subdivisions=args.subdivisions)
+
+    print(f"Mesh with {len(mesh.faces)} faces, {len(pickle.dumps(mesh)) / 1024**2:.1f} MB pickled")
+
+    results = benchmark_handoff(mesh, n_workers=args.n_workers, n_tasks=args.n_tasks)
+    for name, result in results.items():
+        print(f"{name}: {result['time_s']:.2f} s, {result['worker_private_memory_mb']:.1f} MB private memory per worker")
@@ -0,0 +1,241 @@
+from pathlib import Path
+import threading
+import argparse
+import queue
+import time
+import os
+import batch_scheduler as bs
+import script_utils
+
+
+COMPUTE_STAGES = [
+    "02_decimation.py",
+    "03_soma_identification.py",
+    "04_decomposition.py",
+    "05_soma_splitting.py",
+    "06_proofreading.py",
+]
+
+STAGE_ARGS = {
+    "06_proofreading.py": ["--split_num", "all"],
+}
+
+
+def downloaded_files(segment_id, base_dir=""):
+    """
+    Files written by 01_data_collection.py for a segment
+    """
+    return [f"{base_dir}{segment_id}.off", f"{base_dir}{segment_id}_synapses.csv"]
+
+
+class StageTimer:
+    """
+    Thread safe accumulator of the time spent busy in every stage.
+    """
+    def __init__(self):
+        self.busy = dict()
+        self._lock = threading.Lock()
+
+    def add(self, stage, seconds):
+        with self._lock:
+            self.busy[stage] = self.busy.get(stage, 0.0) + seconds
+
+
+class StreamingPipeline:
+    """
+    Runs the pipeline over a list of segments with downloads overlapping the compute stages.
+
+    A background I/O thread downloads the mesh and synapses of the next segments (01_data_collection)
+    while n_compute_workers threads run stages 02-06 on segments that are already downloaded. The two
+    sides are connected by a queue of at most prefetch segments, so downloads stay at most prefetch
+    segments ahead, and downloads also pause while the downloaded data of segments that are not
+    finished yet exceeds max_cache_bytes.
+
+    Parameters
+    ----------
+    segment_ids : list
+        Segments to process, in order
+    base_dir : str
+        Directory the pipeline results are saved in. Must end with /
+    prefetch : int
+        Number of downloaded segments that may wait for a compute worker
+    max_cache_bytes : int
+        Bytes of downloaded data of unfinished segments at which downloads pause
+    n_compute_workers : int
+        Number of segments processed at the same time
+    stages : list
+        Stage scripts run on every segment
+    remove_downloads : bool
+        Remove the downloaded mesh and synapses once a segment is finished
+    cloudpath : str
+        Precomputed segmentation the meshes are downloaded from, defaults to the minnie65 bucket
+    client : CAVEclient
+        Client the synapses are downloaded from, defaults to minnie65_public at version 117
+    """
+    def __init__(
+        self,
+        segment_ids,
+        base_dir="",
+        prefetch=4,
+        max_cache_bytes=20 * 1024**3,
+        n_compute_workers=1,
+        stages=COMPUTE_STAGES,
+        remove_downloads=False,
+        cloudpath=None,
+        client=None,
+        ):
+        self.segment_ids = list(segment_ids)
+        self.base_dir = base_dir
+        self.max_cache_bytes = max_cache_bytes
+        self.n_compute_workers = n_compute_workers
+        self.stages = stages
+        self.remove_downloads = remove_downloads
+        self.cloudpath = cloudpath
+        self.client = client
+
+        self.data_collection = script_utils.load_script(Path(__file__).parent / "01_data_collection.py", "data_collection")
+        self.queue = queue.Queue(maxsize=prefetch)
+        self.timer = StageTimer()
+        self.failed = []
+
+        # bytes downloaded for segments that are not finished yet
+        self._cache_bytes = dict()
+        self._cache_condition = threading.Condition()
+
+    def _wait_for_cache(self):
+        with self._cache_condition:
+            while sum(self._cache_bytes.values()) >= self.max_cache_bytes:
+                self._cache_condition.wait()
+
+    def _release_cache(self, segment_id):
+        with self._cache_condition:
+            self._cache_bytes.pop(segment_id, None)
+            self._cache_condition.notify_all()
+
+    def download(self, segment_id):
+        """
+        Downloads the mesh and synapses of a segment unless they are already in base_dir.
+        """
+        mesh_filepath, synapse_filepath = downloaded_files(segment_id, self.base_dir)
+
+        if not os.path.exists(mesh_filepath):
+            kwargs = dict(cloudpath=self.cloudpath) if self.cloudpath is not None else dict()
+            self.data_collection.download_mesh(segment_id, self.base_dir, **kwargs)
+        if not os.path.exists(synapse_filepath):
+            self.data_collection.collect_synapses(segment_id, self.base_dir, client=self.client)
+
+    def io_stage(self):
+        try:
+            for segment_id in self.segment_ids:
+                start = time.time()
+                self._wait_for_cache()
+                self.timer.add("io_blocked_on_cache", time.time() - start)
+
+                start = time.time()
+                try:
+                    self.download(segment_id)
+                except Exception as e:
+                    print(f"Download of segment {segment_id} failed: {e}")
+                    self.failed.append((segment_id, "01_data_collection.py"))
+                    continue
+                finally:
+                    self.timer.add("01_data_collection.py", time.time() - start)
+
+                with self._cache_condition:
+                    self._cache_bytes[segment_id] = sum(os.path.getsize(f) for f in downloaded_files(segment_id, self.base_dir))
+
+                # blocks while prefetch segments are waiting, which is the backpressure on downloads
+                start = time.time()
+                self.queue.put(segment_id)
+                self.timer.add("io_blocked_on_queue", time.time() - start)
+        finally:
+            # compute workers stop even if this thread dies, instead of waiting on the queue forever
+            for _ in range(self.n_compute_workers):
+                self.queue.put(None)
+
+    def compute_stage(self):
+        while True:
+            start = time.time()
+            segment_id = self.queue.get()
+            self.timer.add("compute_waiting_for_io", time.time() - start)
+            if segment_id is None:
+                return
+
+            try:
+                for stage in self.stages:
+                    record = bs.run_stage(stage, segment_id, self.base_dir, extra_args=STAGE_ARGS.get(stage))
+                    self.timer.add(stage, record["runtime_s"])
+                    if record["returncode"] != 0:
+                        print(f"Stage {stage} failed for segment {segment_id}")
+                        self.failed.append((segment_id, stage))
+                        break
+            except Exception as e:
+                print(f"Running stage {stage} for segment {segment_id} failed: {e}")
+                self.failed.append((segment_id, stage))
+            finally:
+                # the I/O thread waits for this space, so it is released whatever happened
+                if self.remove_downloads:
+                    for filepath in downloaded_files(segment_id, self.base_dir):
+                        if os.path.exists(filepath):
+                            os.remove(filepath)
+                self._release_cache(segment_id)
+
+    def run(self):
+        """
+        Processes all segments and returns the utilization of every stage.
+
+        Returns
+        -------
+        dict
+            Fraction of the wall time every stage was busy. Compute stages are normalized by the number
+            of compute workers, the io_blocked and compute_waiting entries show where the pipeline stalled
+        """
+        start = time.time()
+        threads = [threading.Thread(target=self.io_stage)]
+        threads += [threading.Thread(target=self.compute_stage) for _ in range(self.n_compute_workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        wall_time = time.time() - start
+
+        utilization = dict(wall_time_s = wall_time)
+        for stage, busy in self.timer.busy.items():
+            n_threads = 1 if stage.startswith("io") or stage == "01_data_collection.py" else self.n_compute_workers
+            utilization[stage] = busy / (wall_time * n_threads)
+        return utilization
+
+
+if __name__ == "__main__":
+    # Runs stages 01-06 over a list of segments, downloading the next segments while the current ones are processed
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--segment_ids", nargs="*", default=[], help="ids of segments to process")
+    parser.add_argument("--segment_id_file", default=None, help="file with one segment id per line")
+    parser.add_argument("--base_dir", default = "", help="base directory to save results in. Must end with /")
+    parser.add_argument("--prefetch", default=4, type=int, help="number of segments downloaded ahead of the compute stages")
+    parser.add_argument("--max_cache_gb", default=20, type=float, help="downloads pause while unfinished segments take this much disk")
+    parser.add_argument("--n_compute_workers", default=1, type=int, help="number of segments processed at the same time")
+    parser.add_argument("--remove_downloads", action="store_true", help="remove downloaded meshes and synapses of finished segments")
+    args = parser.parse_args()
+
+    segment_ids = [int(s) for s in args.segment_ids]
+    if args.segment_id_file is not None:
+        with open(args.segment_id_file, "r") as f:
+            segment_ids += [int(line) for line in f if line.strip()]
+
+    pipeline = StreamingPipeline(
+        segment_ids,
+        base_dir = args.base_dir,
+        prefetch = args.prefetch,
+        max_cache_bytes = args.max_cache_gb * 1024**3,
+        n_compute_workers = args.n_compute_workers,
+        remove_downloads = args.remove_downloads,
+    )
+    utilization = pipeline.run()
+
+    print(f"Processed {len(segment_ids)} segments in {utilization.pop('wall_time_s'):.0f} s")
+    for stage, fraction in utilization.items():
+        print(f"{stage}: {100 * fraction:.1f}% busy")
+    if len(pipeline.failed) > 0:
+        print(f"Failed: {pipeline.failed}")
@@ -1,10 +1,5 @@
-import neurd
 from mesh_tools import trimesh_utils as tu
-from datasci_tools import ipyvolume_utils as ipvu
-from neurd import neuron_visualizations as nviz
 from pathlib import Path
-from cloudvolume import CloudVolume
-import trimesh
 from datasci_tools import system_utils as su
 from neurd.vdi_microns import volume_data_interface as vdi
 from neurd import neuron_pipeline_utils as npu
@@ -1,21 +1,24 @@
-from caveclient import CAVEclient
-import imageryclient as ic
 from tqdm import tqdm
 import numpy as np
 import pickle
 
-if __name__ == "__main__":
-    # This script downloads segmentations around somas of neurons that were proofread in newer versions of microns and 
-    # compares them to the unproofread segmentations. The goal is to calculate how much segmentations overlap to get a 
-    # sense of which neurons could be useful prototypes for proofreading.
-    # Data are downloaded in a large area in low quality to ensure that regions outside of somas are included. An issue
-    # with this early approach is that errors are commonly around more distal, thin processes and not around the soma 
-    # center.
 
-    # Connect to database
-    client = CAVEclient('minnie65_public')
-    old_client = CAVEclient('minnie65_public_v117')
+def find_cells_of_interest(client, old_client):
+    """
+    Finds neurons that were proofread in the newest version of microns but not in the older one.
+
+    Parameters
+    ----------
+    client : CAVEclient
+        Client of the newest version
+    old_client : CAVEclient
+        Client of the older version
 
+    Returns
+    -------
+    pd.DataFrame
+        Proofreading status of the cells of interest
+    """
     # collect neurons that have been manually proofread
     old_proofreads = old_client.materialize.query_table('proofreading_status_public_release', split_positions=True)
     new_proofreads = client.materialize.query_table('proofreading_status_and_strategy', split_positions=True)
@@ -27,8 +30,64 @@ if __name__ == "__main__":
     cells_of_interest = cells_of_interest[~cells_of_interest["pt_position_y"].isin(old_proofreads["pt_position_y"])]
     cells_of_interest = cells_of_interest[~cells_of_interest["pt_position_z"].isin(old_proofreads["pt_position_z"])]
 
-    cells_of_interest = cells_of_interest.reset_index()
+    return cells_of_interest.reset_index()
+
+
+def segmentation_overlap(img_client, img_client_old, ctr, size=1024*4, depth=256):
+    """
+    Downloads the new and old segmentation around ctr in low resolution and calculates which proportion
+    of the voxels of the cell in the center kept their classification.
+
+    Parameters
+    ----------
+    img_client : ImageryClient
+        Client of the newest version
+    img_client_old : ImageryClient
+        Client of the older version
+    ctr : list
+        Center of the cutout
+    size : int
+        Size of the cutout in x and y
+    depth : int
+        Size of the cutout in z
+
+    Returns
+    -------
+    float
+        Overlap of the cell label in both segmentations
+    """
+    # Collect old segmentation in low res
+    old_segs = img_client_old.segmentation_cutout(ctr, bbox_size=(size,size, depth), mip=3)
+
+    # Label of cell will be most common label in segmentation
+    label, counts = np.unique(old_segs, return_counts=True)
+    cell_label_old = label[np.argmax(counts)]
+
+    # Repeat for new segmentation
+    segs = img_client.segmentation_cutout(ctr, bbox_size=(size,size, depth), mip=3)
+
+    label, counts = np.unique(segs, return_counts=True)
+    cell_label_new = label[np.argmax(counts)]
+
+    # Calculate which proportion of pixel classification remained the same
+    return len(segs[(segs == cell_label_new) & (old_segs == cell_label_old)]) / np.max(counts)
+
 
+if __name__ == "__main__":
+    # This script downloads segmentations around somas of neurons that were proofread in newer versions of microns and
+    # compares them to the unproofread segmentations. The goal is to calculate how much segmentations overlap to get a
+    # sense of which neurons could be useful prototypes for proofreading.
+    # Data are downloaded in a large area in low quality to ensure that regions outside of somas are included. An issue
+    # with this early approach is that errors are commonly around more distal, thin processes and not around the soma
+    # center.
+    from caveclient import CAVEclient
+    import imageryclient as ic
+
+    # Connect to database
+    client = CAVEclient('minnie65_public')
+    old_client = CAVEclient('minnie65_public_v117')
+
+    cells_of_interest = find_cells_of_interest(client, old_client)
 
     # Download segmentation around each soma
     size = 1024*4
@@ -41,26 +100,13 @@ if __name__ == "__main__":
     skipped_cells = []
 
     # One intersting inhibitory neuron
-    idx = cells_of_interest[cells_of_interest["pt_root_id"] == 864691135526405723].index[0]
+    root_id = 864691135526405723
+    idx = cells_of_interest[cells_of_interest["pt_root_id"] == root_id].index[0]
     x, y, z = cells_of_interest.iloc[idx][["pt_position_x", "pt_position_y", "pt_position_z"]]
 
     ctr = [x, y, z]
 
-    # Collect old segmentation in low res
-    old_segs = img_client_old.segmentation_cutout(ctr, bbox_size=(size,size, depth), mip=3)
-
-    # Label of cell will be most common label in segmentation
-    label, counts = np.unique(old_segs, return_counts=True)
-    cell_label_old = label[np.argmax(counts)]
-
-    # Repeat for new segmentation
-    segs = img_client.segmentation_cutout(ctr, bbox_size=(size,size, depth), mip=3)
-
-    label, counts = np.unique(segs, return_counts=True)
-    cell_label_new = label[np.argmax(counts)]
-
-    # Calculate which proportion of pixel classification remained the same
-    overlap = len(segs[(segs == cell_label_new) & (old_segs == cell_label_old)]) / np.max(counts)
-    print(f"{i}: {overlap}")
+    overlap = segmentation_overlap(img_client, img_client_old, ctr, size=size, depth=depth)
+    print(f"{root_id}: {overlap}")
 
-    overlaps[i] = overlap
+    overlaps[root_id] = overlap
@@ -2,8 +2,9 @@ import numpy as np
 import kimimaro
 from glob import glob
 import argparse
-from em_erl.erl import skel_to_erlgraph
-from em_erl.eval import compute_erl_score
+import time
+import sys
+import skeleton_graph as sg
 
 
 def load_data(path):
@@ -94,91 +95,157 @@ def compute_segment_lut(
         mask_id = np.concatenate(mask_id)
     return node_lut, mask_id
 
-if __name__ == "__main__":
-    # This script loads in segmentation data and prints out erl score for both
-    
-    parser = argparse.ArgumentParser()
-    parser.add_argument("--gt_path", help="path to ground truth segmentation directory", required=True)
-    parser.add_argument("--proof_path", help="path to proofread segmentation directory", required=True)
-    parser.add_argument("--anisotropy", default=(40, 4, 4), help="pixel size in nm. Format: (z, y, x)")
-    args = parser.parse_args()
-
-    # load data
-    gt_seg = load_data(args.gt_path)
-    proof_seg = load_data(args.proof_path)
-    anisotropy = args.anisotropy
-
-    # Make graphs from skeletons
-    gt_skels = kimimaro.skeletonize(
-        gt_seg, 
-        teasar_params={
-            "scale": 1.5, 
-            "const": 300, # physical units
-            "pdrf_scale": 100000,
-            "pdrf_exponent": 4,
-            "soma_acceptance_threshold": 3500, # physical units
-            "soma_detection_threshold": 750, # physical units
-            "soma_invalidation_const": 300, # physical units
-            "soma_invalidation_scale": 2,
-            "max_paths": 300, # default None
-        },
-        dust_threshold=1000, # skip connected components with fewer than this many voxels
-        anisotropy=anisotropy, # default True
-        fix_branching=True, # default True
-        fix_borders=True, # default True
-        fill_holes=True, # default False
-        fix_avocados=True, # default False
-        progress=True, # default False, show progress bar
-        parallel=1, # <= 0 all cpu, 1 single process, 2+ multiprocess
-        parallel_chunk_size=100, # how many skeletons to process before updating progress bar
+def skeletonize(seg, anisotropy):
+    """
+    Skeletonizes every label of a segmentation with the TEASAR parameters used for all ERL calculations.
+    """
+    return kimimaro.skeletonize(
+        seg,
+        teasar_params=sg.DEFAULT_TEASAR_PARAMS,
+        anisotropy=anisotropy,
+        progress=True, # show progress bar
+        **sg.DEFAULT_SKELETONIZE_PARAMS,
         )
 
-    gt_graph = skel_to_erlgraph(gt_skels)
 
-    proof_skels = kimimaro.skeletonize(
-        proof_seg, 
-        teasar_params={
-            "scale": 1.5, 
-            "const": 300, # physical units
-            "pdrf_scale": 100000,
-            "pdrf_exponent": 4,
-            "soma_acceptance_threshold": 3500, # physical units
-            "soma_detection_threshold": 750, # physical units
-            "soma_invalidation_const": 300, # physical units
-            "soma_invalidation_scale": 2,
-            "max_paths": 300, # default None
-        },
-        dust_threshold=1000, # skip connected components with fewer than this many voxels
-        anisotropy=anisotropy, # default True
-        fix_branching=True, # default True
-        fix_borders=True, # default True
-        fill_holes=True, # default False
-        fix_avocados=True, # default False
-        progress=True, # default False, show progress bar
-        parallel=1, # <= 0 all cpu, 1 single process, 2+ multiprocess
-        parallel_chunk_size=100, # how many skeletons to process before updating progress bar
-        )
+def node_lut(seg, nodes_position):
+    """
+    Segment id of seg at every node position. Positions rounded to just outside the volume are clipped.
+    """
+    nodes_position = np.clip(nodes_position, 0, np.array(seg.shape) - 1)
+    node_segment_lut, mask_segment_id = compute_segment_lut(seg, nodes_position)
+    return node_segment_lut, mask_segment_id
+
+
+def csr_erl(gt_skels, proof_seg, anisotropy):
+    """
+    ERL of proof_seg along the ground truth skeletons with the vectorized scorer of skeleton_graph.
+    """
+    gt_graph = sg.skels_to_csr_graph(gt_skels)
+    node_segment_lut, mask_segment_id = node_lut(proof_seg, gt_graph.get_nodes_position(anisotropy))
 
-    proof_graph = skel_to_erlgraph(proof_skels)
+    return sg.compute_erl(
+        gt_graph,
+        node_segment_lut,
+        mask_segment_id=mask_segment_id,
+        merge_threshold=0,
+    )
 
-    # Get look up table, linking coordinates of all nodes in proofread graph to segment id in ground truth segmentation
-    nodes_position = proof_graph.get_nodes_position(anisotropy)
-    node_segment_lut, mask_segment_id = compute_segment_lut(gt_seg, nodes_position)
+
+def em_erl_score(gt_skels, proof_seg, anisotropy, verbose=True):
+    """
+    ERL of proof_seg along the ground truth skeletons with em_erl.
+    """
+    from em_erl.erl import skel_to_erlgraph
+    from em_erl.eval import compute_erl_score
+
+    gt_graph = skel_to_erlgraph(gt_skels)
+    node_segment_lut, mask_segment_id = node_lut(proof_seg, gt_graph.get_nodes_position(anisotropy))
 
     score = compute_erl_score(erl_graph=gt_graph,
     node_segment_lut=node_segment_lut,
     mask_segment_id=mask_segment_id,
     merge_threshold=0,
-    verbose=True)
+    verbose=verbose)
 
     score.compute_erl(None)
+    return score
 
-    # print out erl
-    score.print_erl()
 
-    
+def compare_to_em_erl(result, score, rtol=1e-6):
+    """
+    Compares the result of csr_erl with an em_erl score.
+
+    em_erl's score.erl holds [ERL, ground truth ERL, number of skeletons], only the first entry is the
+    ERL of the segmentation. The per skeleton ERLs (score.skeleton_erl) are matched by skeleton id
+    (score.skeleton_id), an AttributeError is raised if the score does not have them.
+
+    Parameters
+    ----------
+    result : dict
+        Result of csr_erl
+    score : em_erl.eval.ERLScore
+        Result of em_erl_score
+    rtol : float
+        Relative tolerance
+
+    Returns
+    -------
+    list
+        Descriptions of the mismatches, empty if both scorers agree
+    """
+    mismatches = []
+
+    em_erl_value = float(np.atleast_1d(score.erl)[0])
+    if not np.isclose(result["erl"], em_erl_value, rtol=rtol):
+        mismatches.append(f"ERL {result['erl']:.6f} != em_erl {em_erl_value:.6f}")
+
+    # without em_erl's ids the per skeleton values could only be paired by position, which proves nothing
+    missing = [name for name in ["skeleton_id", "skeleton_erl"] if not hasattr(score, name)]
+    if len(missing) > 0:
+        raise AttributeError(f"em_erl score has no {', '.join(missing)}, cannot compare per skeleton ERLs")
 
-   
+    em_erl_ids = np.asarray(score.skeleton_id)
+    if not np.array_equal(np.sort(result["skeleton_ids"]), np.sort(em_erl_ids)):
+        mismatches.append("skeleton ids differ")
+        return mismatches
 
+    order = np.searchsorted(result["skeleton_ids"], em_erl_ids)
+    skeleton_erl = result["skeleton_erl"][order]
+    em_erl_skeleton_erl = np.asarray(score.skeleton_erl, dtype=np.float64)
+    for skeleton_id, value, em_erl_value in zip(em_erl_ids, skeleton_erl, em_erl_skeleton_erl):
+        if not np.isclose(value, em_erl_value, rtol=rtol):
+            mismatches.append(f"skeleton {skeleton_id}: ERL {value:.6f} != em_erl {em_erl_value:.6f}")
 
-    
\ No newline at end of file
+    return mismatches
+
+
+if __name__ == "__main__":
+    # This script loads in segmentation data and prints out the erl score of the proofread segmentation
+    # measured along skeletons of the ground truth segmentation.
+    # --validate scores with both the vectorized scorer and em_erl and exits with 1 if the results differ.
+    # --synthetic uses a generated volume with known splits and merges instead of --gt_path and --proof_path.
+    
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--gt_path", help="path to ground truth segmentation directory")
+    parser.add_argument("--proof_path", help="path to proofread segmentation directory")
+    parser.add_argument("--anisotropy", default=(40, 4, 4), type=int, nargs=3, help="pixel size in nm. Format: (z, y, x)")
+    parser.add_argument("--scorer", default="csr", choices=["csr", "em_erl"], help="ERL implementation to use")
+    parser.add_argument("--validate", action="store_true", help="compare the vectorized scorer against em_erl")
+    parser.add_argument("--synthetic", action="store_true", help="use a synthetic volume")
+    args = parser.parse_args()
+
+    anisotropy = tuple(args.anisotropy)
+
+    # load data
+    if args.synthetic:
+        gt_seg, proof_seg = sg.make_synthetic_volume()
+    else:
+        if args.gt_path is None or args.proof_path is None:
+            parser.error("--gt_path and --proof_path are required without --synthetic")
+        gt_seg = load_data(args.gt_path)
+        proof_seg = load_data(args.proof_path)
+
+    # Make skeletons of the ground truth, the proofread segmentation is looked up at their nodes
+    gt_skels = skeletonize(gt_seg, anisotropy)
+
+    if args.scorer == "csr" or args.validate:
+        start = time.time()
+        result = csr_erl(gt_skels, proof_seg, anisotropy)
+        print(f"ERL: {result['erl']:.1f} ({len(result['merged_segments'])} merged segments, {time.time() - start:.3f} s)")
+
+    if args.scorer == "em_erl" or args.validate:
+        start = time.time()
+        score = em_erl_score(gt_skels, proof_seg, anisotropy)
+        print(f"em_erl scoring took {time.time() - start:.3f} s")
+        # print out erl
+        score.print_erl()
+
+    if args.validate:
+        mismatches = compare_to_em_erl(result, score)
+        if len(mismatches) > 0:
+            print("Vectorized scorer does not match em_erl:")
+            for mismatch in mismatches:
+                print(f"    {mismatch}")
+            sys.exit(1)
+        print("Vectorized scorer matches em_erl")
@@ -0,0 +1,302 @@
+import numpy as np
+
+
+# TEASAR parameters of kimimaro.skeletonize shared by all skeleton based tools, so that ERL and
+# skeleton comparisons are made on the same skeletons
+DEFAULT_TEASAR_PARAMS = {
+    "scale": 1.5,
+    "const": 300, # physical units
+    "pdrf_scale": 100000,
+    "pdrf_exponent": 4,
+    "soma_acceptance_threshold": 3500, # physical units
+    "soma_detection_threshold": 750, # physical units
+    "soma_invalidation_const": 300, # physical units
+    "soma_invalidation_scale": 2,
+    "max_paths": 300, # default None
+}
+
+# remaining keyword arguments of kimimaro.skeletonize
+DEFAULT_SKELETONIZE_PARAMS = dict(
+    dust_threshold=1000, # skip connected components with fewer than this many voxels
+    fix_branching=True, # default True
+    fix_borders=True, # default True
+    fill_holes=True, # default False
+    fix_avocados=True, # default False
+    parallel=1, # <= 0 all cpu, 1 single process, 2+ multiprocess
+    parallel_chunk_size=100, # how many skeletons to process before updating progress bar
+)
+
+
+class SkeletonGraph:
+    """
+    Compact array-backed (CSR-style) graph of many skeletons.
+
+    Nodes and edges of all skeletons are stored in single arrays, the nodes and edges of skeleton i are
+    node_positions[node_offsets[i]:node_offsets[i + 1]] and edges[edge_offsets[i]:edge_offsets[i + 1]].
+
+    Attributes
+    ----------
+    skeleton_ids : np.ndarray
+        Label of every skeleton, shape (n_skeletons,)
+    node_positions : np.ndarray
+        float32 positions of all nodes in physical units, shape (n_nodes, 3)
+    edges : np.ndarray
+        Global node indices of the two ends of every edge, shape (n_edges, 2)
+    node_offsets : np.ndarray
+        Index of the first node of every skeleton, shape (n_skeletons + 1,)
+    edge_offsets : np.ndarray
+        Index of the first edge of every skeleton, shape (n_skeletons + 1,)
+    """
+    def __init__(self, skeleton_ids, node_positions, edges, node_offsets, edge_offsets):
+        self.skeleton_ids = np.asarray(skeleton_ids)
+        self.node_positions = np.asarray(node_positions, dtype=np.float32)
+        self.edges = np.asarray(edges, dtype=np.int64).reshape(-1, 2)
+        self.node_offsets = np.asarray(node_offsets, dtype=np.int64)
+        self.edge_offsets = np.asarray(edge_offsets, dtype=np.int64)
+
+    @property
+    def n_skeletons(self):
+        return len(self.skeleton_ids)
+
+    @property
+    def node_skeleton(self):
+        """
+        Index of the skeleton every node belongs to
+        """
+        return np.repeat(np.arange(self.n_skeletons), np.diff(self.node_offsets))
+
+    @property
+    def edge_skeleton(self):
+        """
+        Index of the skeleton every edge belongs to
+        """
+        return np.repeat(np.arange(self.n_skeletons), np.diff(self.edge_offsets))
+
+    @property
+    def edge_lengths(self):
+        """
+        Physical length of every edge
+        """
+        positions = self.node_positions.astype(np.float64)
+        return np.linalg.norm(positions[self.edges[:, 0]] - positions[self.edges[:, 1]], axis=1)
+
+    @property
+    def skeleton_lengths(self):
+        """
+        Total physical length of every skeleton
+        """
+        return np.bincount(self.edge_skeleton, weights=self.edge_lengths, minlength=self.n_skeletons)
+
+    def get_nodes_position(self, anisotropy):
+        """
+        Voxel coordinates of all nodes, for looking up the segment each node falls into.
+
+        Parameters
+        ----------
+        anisotropy : tuple
+            Voxel size in physical units, in the axis order of the volume
+
+        Returns
+        -------
+        np.ndarray
+            int coordinates of all nodes, shape (n_nodes, 3)
+        """
+        return np.round(self.node_positions / np.asarray(anisotropy, dtype=np.float32)).astype(int)
+
+
+def skels_to_csr_graph(skels):
+    """
+    Turns kimimaro skeletons into a SkeletonGraph.
+
+    Parameters
+    ----------
+    skels : dict
+        Skeletons keyed by label, as returned by kimimaro.skeletonize
+
+    Returns
+    -------
+    SkeletonGraph
+        Graph of all skeletons, in the order of their labels
+    """
+    skeleton_ids = np.array(sorted(skels.keys()))
+    vertices = [skels[label].vertices for label in skeleton_ids]
+    edges = [skels[label].edges for label in skeleton_ids]
+
+    node_offsets = np.concatenate([[0], np.cumsum([len(v) for v in vertices])]).astype(np.int64)
+    edge_offsets = np.concatenate([[0], np.cumsum([len(e) for e in edges])]).astype(np.int64)
+
+    if len(skeleton_ids) == 0:
+        return SkeletonGraph(skeleton_ids, np.zeros((0, 3)), np.zeros((0, 2)), node_offsets, edge_offsets)
+
+    # shift the local edge indices of every skeleton by the offset of its first node
+    edge_node_offset = np.repeat(node_offsets[:-1], np.diff(edge_offsets))
+    global_edges = np.concatenate(edges).astype(np.int64).reshape(-1, 2) + edge_node_offset[:, None]
+
+    return SkeletonGraph(
+        skeleton_ids = skeleton_ids,
+        node_positions = np.concatenate(vertices),
+        edges = global_edges,
+        node_offsets = node_offsets,
+        edge_offsets = edge_offsets,
+    )
+
+
+def merged_segments(graph, node_segment_lut, mask_segment_id=None, merge_threshold=0):
+    """
+    Finds the segments that merge skeletons. A segment is merged if more than merge_threshold nodes of
+    two or more skeletons fall into it, or if more than merge_threshold voxels of it lie in the mask.
+
+    Parameters
+    ----------
+    graph : SkeletonGraph
+        Ground truth skeletons
+    node_segment_lut : np.ndarray
+        Segment id every node falls into
+    mask_segment_id : np.ndarray
+        Segment ids of all voxels inside the mask (e.g. regions without ground truth)
+    merge_threshold : int
+        Number of nodes or mask voxels a segment may have before it counts as merged
+
+    Returns
+    -------
+    np.ndarray
+        Sorted ids of all merged segments, 0 is never reported
+    """
+    segments, segment_idx = np.unique(node_segment_lut, return_inverse=True)
+    segment_idx = segment_idx.reshape(-1)
+
+    # nodes per (skeleton, segment) pair
+    pairs, pair_counts = np.unique(
+        graph.node_skeleton.astype(np.int64) * len(segments) + segment_idx,
+        return_counts=True,
+    )
+    touching_pairs = pairs[pair_counts > merge_threshold]
+    skeletons_per_segment = np.bincount(touching_pairs % len(segments), minlength=len(segments))
+    merged = skeletons_per_segment > 1
+
+    if mask_segment_id is not None and len(mask_segment_id) > 0:
+        mask_ids, mask_counts = np.unique(np.asarray(mask_segment_id), return_counts=True)
+        mask_ids = mask_ids[mask_counts > merge_threshold]
+        merged |= np.isin(segments, mask_ids)
+
+    merged &= segments != 0
+    return segments[merged]
+
+
+def compute_erl(graph, node_segment_lut, mask_segment_id=None, merge_threshold=0):
+    """
+    Vectorized expected run length of a segmentation along ground truth skeletons.
+
+    An edge is correct if both of its nodes fall into the same, non-zero and unmerged segment.
+    The run length of a skeleton inside a segment is the length of its correct edges in that segment,
+    the ERL of a skeleton is the sum of its squared run lengths divided by its length and the
+    total ERL is the length weighted mean over skeletons.
+
+    Parameters
+    ----------
+    graph : SkeletonGraph
+        Ground truth skeletons
+    node_segment_lut : np.ndarray
+        Segment id every node falls into, see compute_segment_lut
+    mask_segment_id : np.ndarray
+        Segment ids of all voxels inside the mask
+    merge_threshold : int
+        See merged_segments
+
+    Returns
+    -------
+    dict
+        erl: total ERL
+        skeleton_ids: label of every skeleton
+        skeleton_erl: ERL of every skeleton
+        skeleton_lengths: length of every skeleton
+        merged_segments: ids of merged segments
+    """
+    node_segment_lut = np.asarray(node_segment_lut).reshape(-1)
+    merged = merged_segments(graph, node_segment_lut, mask_segment_id, merge_threshold)
+
+    edge_segments = node_segment_lut[graph.edges]
+    correct = (
+        (edge_segments[:, 0] == edge_segments[:, 1])
+        & (edge_segments[:, 0] != 0)
+        & ~np.isin(edge_segments[:, 0], merged)
+    )
+
+    edge_skeleton = graph.edge_skeleton[correct]
+    edge_lengths = graph.edge_lengths
+    skeleton_lengths = np.bincount(graph.edge_skeleton, weights=edge_lengths, minlength=graph.n_skeletons)
+
+    # sum the correct edge lengths per (skeleton, segment) run, then the squared runs per skeleton
+    _, segment_idx = np.unique(edge_segments[correct, 0], return_inverse=True)
+    n_segments = segment_idx.max() + 1 if len(segment_idx) > 0 else 1
+    runs, run_idx = np.unique(edge_skeleton.astype(np.int64) * n_segments + segment_idx.reshape(-1), return_inverse=True)
+    run_lengths = np.bincount(run_idx.reshape(-1), weights=edge_lengths[correct], minlength=len(runs))
+    squared_runs = np.bincount(runs // n_segments, weights=run_lengths ** 2, minlength=graph.n_skeletons)
+
+    skeleton_erl = np.divide(squared_runs, skeleton_lengths, out=np.zeros(graph.n_skeletons), where=skeleton_lengths > 0)
+    total_length = skeleton_lengths.sum()
+
+    return dict(
+        erl = float(squared_runs.sum() / total_length) if total_length > 0 else 0.0,
+        skeleton_ids = graph.skeleton_ids,
+        skeleton_erl = skeleton_erl,
+        skeleton_lengths = skeleton_lengths,
+        merged_segments = merged,
+    )
+
+
+def make_synthetic_volume(shape=(64, 256, 256), n_objects=20, radius=3, n_splits=3, n_merges=2, seed=0):
+    """
+    Makes a ground truth volume of random tubes and a segmentation of it with known splits and merges,
+    for validating ERL scorers.
+
+    Parameters
+    ----------
+    shape : tuple
+        Shape of the volume (z, y, x)
+    n_objects : int
+        Number of tubes
+    radius : int
+        Radius of the tubes in voxels
+    n_splits : int
+        Number of tubes that are cut in two segments in the segmentation
+    n_merges : int
+        Number of pairs of tubes that share a segment in the segmentation
+    seed : int
+        Random seed
+
+    Returns
+    -------
+    tuple
+        ground truth and segmentation volumes as uint32 arrays
+    """
+    rng = np.random.default_rng(seed)
+    shape = np.asarray(shape)
+    gt = np.zeros(shape, dtype=np.uint32)
+    grid = np.stack(np.meshgrid(*[np.arange(s) for s in shape], indexing="ij"), axis=-1).astype(np.float32)
+
+    for label in range(1, n_objects + 1):
+        start = rng.uniform(0, shape)
+        end = rng.uniform(0, shape)
+        direction = end - start
+        # distance of every voxel to the segment from start to end
+        t = np.clip(((grid - start) @ direction) / (direction @ direction), 0, 1)
+        distance = np.linalg.norm(grid - (start + t[..., None] * direction), axis=-1)
+        gt[(distance <= radius) & (gt == 0)] = label
+
+    seg = gt.copy()
+    labels = rng.permutation(np.arange(1, n_objects + 1))
+
+    for label in labels[:n_splits]:
+        # relabel the half of the tube above its median z
+        voxels = np.argwhere(gt == label)
+        if len(voxels) == 0:
+            continue
+        upper = voxels[voxels[:, 0] > np.median(voxels[:, 0])]
+        seg[upper[:, 0], upper[:, 1], upper[:, 2]] = label + n_objects
+
+    for i in range(n_merges):
+        a, b = labels[n_splits + 2 * i: n_splits + 2 * i + 2]
+        seg[seg == b] = a
+
+    return gt, seg
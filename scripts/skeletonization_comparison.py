@@ -1,9 +1,12 @@
-import numpy as np 
+import numpy as np
+import pandas as pd
 import kimimaro
 from glob import glob
+from scipy.spatial import cKDTree
 import argparse
-from em_erl.erl import skel_to_erlgraph
-from em_erl.eval import compute_erl_score
+import json
+import time
+import skeleton_graph as sg
 
 
 def load_data(path):
@@ -32,148 +35,307 @@ def load_data(path):
 
     return out
 
-# Stolen from PytorchConnectomics/em_erl
-# https://github.com/PytorchConnectomics/em_erl/blob/main/em_erl/eval.py
-def compute_segment_lut(
-    segment, node_position, mask=None, chunk_num=1, data_type=np.uint32
-):
-    """
-    The function `compute_segment_lut` is a low memory version of a lookup table
-    computation for node segments in a 3D volume.
-
-    :param node_position: A numpy array containing the coordinates of each node. The shape of the array
-    is (N, 3), where N is the number of nodes and each row represents the (z, y, x) coordinates of a
-    node
-    :param segment: either a 3D volume or a string representing the
-    name of a file containing segment data.
-    :param chunk_num: The parameter `chunk_num` is the number of chunks into which the volume is divided
-    for reading. It is used in the `read_vol` function to specify which chunk to read, defaults to 1
-    (optional)
-    :param data_type: The parameter `data_type` is the data type of the array used to store the node segment
-    lookup table. In this case, it is set to `np.uint32`, which means the array will store unsigned
-    32-bit integers
-    :return: a list of numpy arrays, where each array represents the node segment lookup table for a
-    specific segment.
+
+def skeletonize(seg, anisotropy, teasar_params=None):
     """
-    if not isinstance(segment, str):
-        # load the whole segment
-        node_lut = segment[
-            node_position[:, 0], node_position[:, 1], node_position[:, 2]
-        ]
-        mask_id = []
-        if mask is not None:
-            if isinstance(mask, str):
-                mask = read_vol(mask)
-            mask_id = segment[mask > 0]
-    else:
-        # read segment by chunk (when memory is limited)
-        assert ".h5" in segment
-        node_lut = np.zeros(node_position.shape[0], data_type)
-        mask_id = [[]] * chunk_num
-        start_z = 0
-        for chunk_id in range(chunk_num):
-            seg = read_vol(segment, None, chunk_id, chunk_num)
-            last_z = start_z + seg.shape[0]
-            ind = (node_position[:, 0] >= start_z) * (node_position[:, 0] < last_z)
-            pts = node_position[ind]
-            node_lut[ind] = seg[pts[:, 0] - start_z, pts[:, 1], pts[:, 2]]
-            if mask is not None:
-                if isinstance(mask, str):
-                    mask_z = read_vol(mask, None, chunk_id, chunk_num)
-                else:
-                    mask_z = mask[start_z:last_z]
-                mask_id[chunk_id] = seg[mask_z > 0]
-            start_z = last_z
-        if mask is not None:
-            # remove irrelevant seg ids (not used by nodes)
-            node_lut_unique = np.unique(node_lut)
-            for chunk_id in range(chunk_num):
-                mask_id[chunk_id] = mask_id[chunk_id][
-                    np.in1d(mask_id[chunk_id], node_lut_unique)
-                ]
-        mask_id = np.concatenate(mask_id)
-    return node_lut, mask_id
+    Skeletonizes every label of a segmentation and returns the skeletons as a SkeletonGraph.
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser()
-    parser.add_argument("--gt_path", help="path to ground truth segmentation directory", required=True)
-    parser.add_argument("--proof_path", help="path to proofread segmentation directory", required=True)
-    parser.add_argument("--anisotropy", default=(40, 4, 4), help="pixel size in nm. Format: (x, y, z)")
-    args = parser.parse_args()
+    Parameters
+    ----------
+    seg : np.ndarray
+        Segmentation volume
+    anisotropy : tuple
+        Voxel size in physical units
+    teasar_params : dict
+        TEASAR parameters overriding sg.DEFAULT_TEASAR_PARAMS
 
-    gt_seg = load_data(args.gt_path)
-    proof_seg = load_data(args.proof_path)
-    anisotropy = args.anisotropy
-
-    gt_skels = kimimaro.skeletonize(
-        gt_seg, 
-        teasar_params={
-            "scale": 1.5, 
-            "const": 300, # physical units
-            "pdrf_scale": 100000,
-            "pdrf_exponent": 4,
-            "soma_acceptance_threshold": 3500, # physical units
-            "soma_detection_threshold": 750, # physical units
-            "soma_invalidation_const": 300, # physical units
-            "soma_invalidation_scale": 2,
-            "max_paths": 300, # default None
-        },
-        dust_threshold=1000, # skip connected components with fewer than this many voxels
-        anisotropy=anisotropy, # default True
-        fix_branching=True, # default True
-        fix_borders=True, # default True
-        fill_holes=True, # default False
-        fix_avocados=True, # default False
-        progress=True, # default False, show progress bar
-        parallel=1, # <= 0 all cpu, 1 single process, 2+ multiprocess
-        parallel_chunk_size=100, # how many skeletons to process before updating progress bar
+    Returns
+    -------
+    SkeletonGraph
+        Skeletons of all labels, node positions in physical units
+    """
+    skels = kimimaro.skeletonize(
+        seg,
+        teasar_params={**sg.DEFAULT_TEASAR_PARAMS, **(teasar_params or dict())},
+        anisotropy=anisotropy,
+        progress=False,
+        **sg.DEFAULT_SKELETONIZE_PARAMS,
         )
+    return sg.skels_to_csr_graph(skels)
+
+
+def topology(graph):
+    """
+    Number of endpoints (degree 1) and branch points (degree 3 or more) of every skeleton.
+
+    Returns
+    -------
+    tuple
+        endpoints and branch points per skeleton
+    """
+    degree = np.bincount(graph.edges.reshape(-1), minlength=len(graph.node_positions))
+    node_skeleton = graph.node_skeleton
+    endpoints = np.bincount(node_skeleton, weights=degree == 1, minlength=graph.n_skeletons).astype(int)
+    branches = np.bincount(node_skeleton, weights=degree >= 3, minlength=graph.n_skeletons).astype(int)
+    return endpoints, branches
 
-    gt_graph = skel_to_erlgraph(gt_skels)
-
-    proof_skels = kimimaro.skeletonize(
-        proof_seg, 
-        teasar_params={
-            "scale": 1.5, 
-            "const": 300, # physical units
-            "pdrf_scale": 100000,
-            "pdrf_exponent": 4,
-            "soma_acceptance_threshold": 3500, # physical units
-            "soma_detection_threshold": 750, # physical units
-            "soma_invalidation_const": 300, # physical units
-            "soma_invalidation_scale": 2,
-            "max_paths": 300, # default None
-        },
-        dust_threshold=1000, # skip connected components with fewer than this many voxels
-        anisotropy=anisotropy, # default True
-        fix_branching=True, # default True
-        fix_borders=True, # default True
-        fill_holes=True, # default False
-        fix_avocados=True, # default False
-        progress=True, # default False, show progress bar
-        parallel=1, # <= 0 all cpu, 1 single process, 2+ multiprocess
-        parallel_chunk_size=100, # how many skeletons to process before updating progress bar
-        )
 
-    proof_graph = skel_to_erlgraph(proof_skels)
+def match_edges(graph, other_graph, tolerance):
+    """
+    Matches the edges of graph to the nodes of other_graph. An edge is matched if both of its nodes
+    lie within tolerance of a node of other_graph, and it is assigned to the skeleton of the node
+    nearest to its first node.
+
+    Returns
+    -------
+    tuple
+        boolean mask of matched edges and the skeleton index in other_graph every edge is assigned to
+        (-1 for unmatched edges)
+    """
+    n_edges = len(graph.edges)
+    if len(other_graph.node_positions) == 0 or n_edges == 0:
+        return np.zeros(n_edges, dtype=bool), np.full(n_edges, -1)
+
+    tree = cKDTree(other_graph.node_positions)
+    distance, nearest = tree.query(graph.node_positions, distance_upper_bound=tolerance)
+    node_matched = np.isfinite(distance)
+
+    edge_matched = node_matched[graph.edges[:, 0]] & node_matched[graph.edges[:, 1]]
+
+    other_node_skeleton = other_graph.node_skeleton
+    edge_skeleton = np.full(n_edges, -1)
+    edge_skeleton[edge_matched] = other_node_skeleton[nearest[graph.edges[edge_matched, 0]]]
+    return edge_matched, edge_skeleton
+
+
+def compare_skeletons(graph, other_graph, tolerance=500, anisotropy=None, min_overlap=0.1):
+    """
+    Compares two sets of skeletons: path length precision/recall per label, differences in endpoint
+    and branch point counts, and split/merge correspondences between labels.
+
+    graph is treated as the reference: recall is the fraction of a reference label's path length that
+    is matched by other_graph, precision the fraction of an other_graph label's path length that is
+    matched by the reference.
+
+    Parameters
+    ----------
+    graph : SkeletonGraph
+        Reference skeletons
+    other_graph : SkeletonGraph
+        Skeletons to compare against the reference
+    tolerance : float
+        Maximum distance between matched nodes in physical units
+    anisotropy : tuple
+        Voxel size, only needed if the node positions are in voxels instead of physical units
+    min_overlap : float
+        Fraction of a label's path length that has to be matched to another label for it to count
+        in a split or merge
+
+    Returns
+    -------
+    dict
+        reference: per label table of the reference skeletons (length, recall, topology, best match)
+        other: per label table of the compared skeletons (length, precision, topology)
+        splits: reference labels matched by several labels of other_graph
+        merges: labels of other_graph matching several reference labels
+    """
+    if anisotropy is not None:
+        scale = np.asarray(anisotropy, dtype=np.float32)
+        graph = sg.SkeletonGraph(graph.skeleton_ids, graph.node_positions * scale, graph.edges, graph.node_offsets, graph.edge_offsets)
+        other_graph = sg.SkeletonGraph(other_graph.skeleton_ids, other_graph.node_positions * scale, other_graph.edges, other_graph.node_offsets, other_graph.edge_offsets)
 
-    nodes_position = proof_graph.get_nodes_position(anisotropy)
+    edge_lengths = graph.edge_lengths
+    other_edge_lengths = other_graph.edge_lengths
+    lengths = np.bincount(graph.edge_skeleton, weights=edge_lengths, minlength=graph.n_skeletons)
+    other_lengths = np.bincount(other_graph.edge_skeleton, weights=other_edge_lengths, minlength=other_graph.n_skeletons)
 
-    node_segment_lut, mask_segment_id = compute_segment_lut(gt_seg, nodes_position)
+    matched, matched_skeleton = match_edges(graph, other_graph, tolerance)
+    other_matched, _ = match_edges(other_graph, graph, tolerance)
 
-    score = compute_erl_score(erl_graph=gt_graph,
-    node_segment_lut=node_segment_lut,
-    mask_segment_id=mask_segment_id,
-    merge_threshold=0,
-    verbose=True)
+    recall = np.bincount(graph.edge_skeleton, weights=edge_lengths * matched, minlength=graph.n_skeletons)
+    precision = np.bincount(other_graph.edge_skeleton, weights=other_edge_lengths * other_matched, minlength=other_graph.n_skeletons)
 
-    score.compute_erl(None)
+    # matched path length of every (reference label, other label) pair
+    n_other = max(other_graph.n_skeletons, 1)
+    pairs, pair_idx = np.unique(graph.edge_skeleton[matched] * n_other + matched_skeleton[matched], return_inverse=True)
+    overlap = np.bincount(pair_idx.reshape(-1), weights=edge_lengths[matched], minlength=len(pairs))
+    pair_skeleton, pair_other = pairs // n_other, pairs % n_other
 
-    score.print_erl()
+    # best match of every reference label is the pair with the largest overlap
+    order = np.lexsort((-overlap, pair_skeleton))
+    first = np.unique(pair_skeleton[order], return_index=True)[1]
+    best_match = np.full(graph.n_skeletons, -1)
+    best_match[pair_skeleton[order][first]] = pair_other[order][first]
+
+    endpoints, branches = topology(graph)
+    other_endpoints, other_branches = topology(other_graph)
+    has_match = best_match >= 0
+
+    # topology of the best match, compared only for labels that have one
+    best_label = np.full(graph.n_skeletons, -1, dtype=np.int64)
+    best_endpoints, best_branches = endpoints.copy(), branches.copy()
+    best_label[has_match] = other_graph.skeleton_ids[best_match[has_match]]
+    best_endpoints[has_match] = other_endpoints[best_match[has_match]]
+    best_branches[has_match] = other_branches[best_match[has_match]]
+
+    reference = pd.DataFrame(dict(
+        label = graph.skeleton_ids,
+        length = lengths,
+        recall = np.divide(recall, lengths, out=np.zeros(graph.n_skeletons), where=lengths > 0),
+        endpoints = endpoints,
+        branches = branches,
+        best_match = best_label,
+        endpoint_difference = best_endpoints - endpoints,
+        branch_difference = best_branches - branches,
+    ))
+    other = pd.DataFrame(dict(
+        label = other_graph.skeleton_ids,
+        length = other_lengths,
+        precision = np.divide(precision, other_lengths, out=np.zeros(other_graph.n_skeletons), where=other_lengths > 0),
+        endpoints = other_endpoints,
+        branches = other_branches,
+    ))
+
+    # a pair counts for splits and merges if it covers at least min_overlap of the reference label
+    significant = overlap >= min_overlap * lengths[pair_skeleton]
+    significant_skeleton, significant_other = pair_skeleton[significant], pair_other[significant]
+
+    split_skeletons = np.flatnonzero(np.bincount(significant_skeleton, minlength=graph.n_skeletons) > 1)
+    merge_others = np.flatnonzero(np.bincount(significant_other, minlength=other_graph.n_skeletons) > 1)
+
+    splits = {
+        int(graph.skeleton_ids[s]): other_graph.skeleton_ids[significant_other[significant_skeleton == s]].tolist()
+        for s in split_skeletons
+    }
+    merges = {
+        int(other_graph.skeleton_ids[o]): graph.skeleton_ids[significant_skeleton[significant_other == o]].tolist()
+        for o in merge_others
+    }
+
+    return dict(
+        reference = reference,
+        other = other,
+        splits = splits,
+        merges = merges,
+    )
+
+
+def summarize(comparison):
+    """
+    Length weighted recall/precision, split and merge counts and mean topology differences of a comparison.
+    """
+    reference = comparison["reference"]
+    other = comparison["other"]
+    return dict(
+        recall = float((reference["recall"] * reference["length"]).sum() / max(reference["length"].sum(), 1e-12)),
+        precision = float((other["precision"] * other["length"]).sum() / max(other["length"].sum(), 1e-12)),
+        n_splits = len(comparison["splits"]),
+        n_merges = len(comparison["merges"]),
+        mean_endpoint_difference = float(reference["endpoint_difference"].abs().mean()) if len(reference) > 0 else 0.0,
+        mean_branch_difference = float(reference["branch_difference"].abs().mean()) if len(reference) > 0 else 0.0,
+    )
+
+
+def compare_parameter_sets(seg, reference_graph, anisotropy, parameter_sets, tolerance=500):
+    """
+    Skeletonizes seg with every set of TEASAR parameters and compares the skeletons against reference_graph.
+
+    Parameters
+    ----------
+    seg : np.ndarray
+        Segmentation to skeletonize
+    reference_graph : SkeletonGraph
+        Skeletons every parameter set is compared against
+    anisotropy : tuple
+        Voxel size in physical units
+    parameter_sets : list
+        dicts of TEASAR parameters, an optional "name" key names the set
+    tolerance : float
+        See compare_skeletons
+
+    Returns
+    -------
+    pd.DataFrame
+        Summary of every parameter set with its skeletonization and comparison times
+    """
+    rows = []
+    for i, parameters in enumerate(parameter_sets):
+        parameters = dict(parameters)
+        name = parameters.pop("name", f"set_{i}")
+
+        start = time.time()
+        graph = skeletonize(seg, anisotropy, teasar_params=parameters)
+        skeletonization_time = time.time() - start
+
+        start = time.time()
+        comparison = compare_skeletons(reference_graph, graph, tolerance=tolerance)
+        rows.append(dict(
+            name = name,
+            n_skeletons = graph.n_skeletons,
+            skeletonization_s = skeletonization_time,
+            comparison_s = time.time() - start,
+            **summarize(comparison),
+        ))
+    return pd.DataFrame(rows)
+
+
+if __name__ == "__main__":
+    # Compares skeletons of two segmentations (e.g. proofread and unproofread), or skeletons of one
+    # segmentation made with several TEASAR parameter sets against its skeletons with the default parameters.
+    #   --param_sets: json file with a list of TEASAR parameter dicts for batch mode
+    #   --synthetic: use a generated volume with known splits and merges instead of --gt_path and --proof_path
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--gt_path", help="path to ground truth segmentation directory")
+    parser.add_argument("--proof_path", help="path to proofread segmentation directory")
+    parser.add_argument("--anisotropy", default=(40, 4, 4), type=int, nargs=3, help="pixel size in nm. Format: (z, y, x)")
+    parser.add_argument("--tolerance", default=500, type=float, help="maximum distance of matched nodes in nm")
+    parser.add_argument("--param_sets", default=None, help="json file with a list of TEASAR parameter sets to compare")
+    parser.add_argument("--output_path", default=None, help="prefix of the csv files the per label tables are saved to")
+    parser.add_argument("--synthetic", action="store_true", help="use a synthetic volume")
+    args = parser.parse_args()
+
+    anisotropy = tuple(args.anisotropy)
+
+    if args.synthetic:
+        gt_seg, proof_seg = sg.make_synthetic_volume()
+    else:
+        if args.gt_path is None:
+            parser.error("--gt_path is required without --synthetic")
+        gt_seg = load_data(args.gt_path)
+        proof_seg = load_data(args.proof_path) if args.proof_path is not None else None
+
+    gt_graph = skeletonize(gt_seg, anisotropy)
+
+    if args.param_sets is not None:
+        with open(args.param_sets, "r") as f:
+            parameter_sets = json.load(f)
+
+        summary = compare_parameter_sets(
+            proof_seg if proof_seg is not None else gt_seg,
+            gt_graph,
+            anisotropy,
+            parameter_sets,
+            tolerance=args.tolerance,
+        )
+        print(summary.to_string(index=False))
+        if args.output_path is not None:
+            summary.to_csv(f"{args.output_path}parameter_sets.csv", index=False)
+    else:
+        if proof_seg is None:
+            parser.error("--proof_path is required without --param_sets")
 
-    
+        proof_graph = skeletonize(proof_seg, anisotropy)
 
-   
+        start = time.time()
+        comparison = compare_skeletons(gt_graph, proof_graph, tolerance=args.tolerance)
+        print(f"Compared {gt_graph.n_skeletons} and {proof_graph.n_skeletons} skeletons in {time.time() - start:.3f} s")
 
+        for key, value in summarize(comparison).items():
+            print(f"{key}: {value}")
+        print(f"splits: {comparison['splits']}")
+        print(f"merges: {comparison['merges']}")
 
-    
\ No newline at end of file
+        if args.output_path is not None:
+            comparison["reference"].to_csv(f"{args.output_path}reference_labels.csv", index=False)
+            comparison["other"].to_csv(f"{args.output_path}compared_labels.csv", index=False)
@@ -0,0 +1,7 @@
+import sys
+from pathlib import Path
+
+# the pipeline scripts import each other by module name from their own directories
+root = Path(__file__).parents[1]
+sys.path.insert(0, str(root / "neurd_scripts"))
+sys.path.insert(0, str(root / "scripts"))
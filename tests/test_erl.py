@@ -0,0 +1,81 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("kimimaro")
+
+import skeleton_graph as sg
+import erl_calculation_from_segmentations as erl
+
+ANISOTROPY = (40, 4, 4)
+
+# ERL and merged segments of sg.make_synthetic_volume() along its kimimaro skeletons. The ERL was
+# computed with the per edge loop below, which follows em_erl's definition, and is checked against
+# em_erl itself in test_compute_erl_matches_em_erl whenever em_erl is installed
+SYNTHETIC_ERL = 1970.807
+SYNTHETIC_MERGED_SEGMENTS = [10, 18]
+
+
+@pytest.fixture(scope="module")
+def volumes():
+    return sg.make_synthetic_volume()
+
+
+@pytest.fixture(scope="module")
+def gt_skels(volumes):
+    gt_seg, _ = volumes
+    return erl.skeletonize(gt_seg, ANISOTROPY)
+
+
+def naive_erl(gt_skels, proof_seg, merged):
+    # per skeleton loop over the edges of every skeleton, accumulating runs per segment
+    squared_runs, total_length = 0.0, 0.0
+    for label in sorted(gt_skels.keys()):
+        skel = gt_skels[label]
+        nodes = np.clip(np.round(skel.vertices / np.array(ANISOTROPY)).astype(int), 0, np.array(proof_seg.shape) - 1)
+        runs = dict()
+        for a, b in skel.edges:
+            length = np.linalg.norm(skel.vertices[a].astype(np.float64) - skel.vertices[b].astype(np.float64))
+            total_length += length
+            segment_a, segment_b = proof_seg[tuple(nodes[a])], proof_seg[tuple(nodes[b])]
+            if segment_a == segment_b and segment_a != 0 and segment_a not in merged:
+                runs[segment_a] = runs.get(segment_a, 0.0) + length
+        squared_runs += sum(run ** 2 for run in runs.values())
+    return squared_runs / total_length
+
+
+def test_compute_erl_matches_naive_loop(volumes, gt_skels):
+    _, proof_seg = volumes
+    result = erl.csr_erl(gt_skels, proof_seg, ANISOTROPY)
+
+    assert result["erl"] == pytest.approx(naive_erl(gt_skels, proof_seg, result["merged_segments"]), rel=1e-6)
+    assert result["erl"] == pytest.approx(SYNTHETIC_ERL, abs=1e-3)
+    assert list(result["merged_segments"]) == SYNTHETIC_MERGED_SEGMENTS
+
+
+def test_compute_erl_matches_em_erl(volumes, gt_skels):
+    pytest.importorskip("em_erl")
+
+    _, proof_seg = volumes
+    result = erl.csr_erl(gt_skels, proof_seg, ANISOTROPY)
+    score = erl.em_erl_score(gt_skels, proof_seg, ANISOTROPY, verbose=False)
+
+    assert float(np.atleast_1d(score.erl)[0]) == pytest.approx(SYNTHETIC_ERL, abs=1e-3)
+    assert erl.compare_to_em_erl(result, score) == []
+
+
+def test_compare_to_em_erl_needs_skeleton_ids():
+    result = dict(erl=1.0, skeleton_ids=np.array([1, 2]), skeleton_erl=np.array([1.0, 1.0]))
+
+    class Score:
+        erl = np.array([1.0, 2.0, 2])
+        skeleton_erl = np.array([1.0, 1.0])
+
+    with pytest.raises(AttributeError):
+        erl.compare_to_em_erl(result, Score())
+
+    Score.skeleton_id = np.array([2, 3])
+    assert erl.compare_to_em_erl(result, Score()) == ["skeleton ids differ"]
+
+    Score.skeleton_id = np.array([2, 1])
+    Score.skeleton_erl = np.array([1.0, 0.5])
+    assert erl.compare_to_em_erl(result, Score()) == ["skeleton 1: ERL 1.000000 != em_erl 0.500000"]
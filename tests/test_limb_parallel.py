@@ -0,0 +1,154 @@
+import textwrap
+import copy
+import sys
+import os
+import numpy as np
+import pytest
+
+trimesh = pytest.importorskip("trimesh")
+
+import limb_parallel as lp
+
+# neurd's decomposition reduced to what limb_parallel relies on: Neuron runs preprocess_neuron, which
+# calls the module level preprocess_limb once per limb and uses the results after the limb loop
+STUB_MODULES = {
+    "__init__.py": "",
+    "preprocess_neuron.py": """
+        import os
+
+        def preprocess_limb(mesh, limb_idx=None):
+            return dict(
+                limb_idx = limb_idx,
+                n_faces = len(mesh.faces),
+                centroid = mesh.vertices.mean(axis=0),
+                pid = os.getpid(),
+            )
+
+        def preprocess_neuron(limb_meshes):
+            limb_correspondence = dict()
+            for i, limb_mesh in enumerate(limb_meshes):
+                limb_correspondence[i] = preprocess_limb(limb_mesh, limb_idx=i)
+            total_faces = sum(c["n_faces"] for c in limb_correspondence.values())
+            return limb_correspondence, total_faces
+    """,
+    "neuron.py": """
+        from neurd import preprocess_neuron as pre
+
+        class Neuron:
+            def __init__(self, mesh, segment_id, pipeline_products, **kwargs):
+                self.mesh = mesh
+                self.segment_id = segment_id
+                self.pipeline_products = pipeline_products
+                self.limb_correspondence, self.total_faces = pre.preprocess_neuron(pipeline_products["limb_meshes"])
+
+            def calculate_decomposition_products(self, store_in_obj=False):
+                products = dict(n_limbs=len(self.limb_correspondence), total_faces=self.total_faces)
+                if store_in_obj:
+                    self.pipeline_products["decomposition"] = products
+                return products
+    """,
+}
+
+
+@pytest.fixture
+def stub_neurd(tmp_path, monkeypatch):
+    package = tmp_path / "neurd"
+    package.mkdir()
+    for filename, source in STUB_MODULES.items():
+        (package / filename).write_text(textwrap.dedent(source))
+
+    saved = {name: module for name, module in sys.modules.items() if name == "neurd" or name.startswith("neurd.")}
+    for name in saved:
+        del sys.modules[name]
+    monkeypatch.syspath_prepend(str(tmp_path))
+
+    yield
+
+    for name in [name for name in sys.modules if name == "neurd" or name.startswith("neurd.")]:
+        del sys.modules[name]
+    sys.modules.update(saved)
+
+
+@pytest.fixture
+def products():
+    limb_meshes = [
+        trimesh.creation.icosphere(subdivisions=s).apply_translation([10 * i, 0, 0])
+        for i, s in enumerate([1, 3, 2])
+    ]
+    return dict(limb_meshes=limb_meshes)
+
+
+@pytest.fixture
+def mesh():
+    return trimesh.creation.icosphere(subdivisions=1)
+
+
+def test_capture_records_every_limb(stub_neurd, mesh, products):
+    calls = lp.capture_limb_calls(mesh, 1, products)
+
+    assert len(calls) == len(products["limb_meshes"])
+    for (args, kwargs), limb_mesh in zip(calls, products["limb_meshes"]):
+        assert lp.mesh_fingerprint(lp._limb_mesh(args, kwargs)) == lp.mesh_fingerprint(limb_mesh)
+
+
+def test_capture_raises_errors_before_the_first_limb(stub_neurd, mesh):
+    with pytest.raises(KeyError):
+        lp.capture_limb_calls(mesh, 1, dict())
+
+
+def test_parallel_replays_worker_results(stub_neurd, mesh, products):
+    serial = lp.build_neuron(mesh, 1, products)
+    neuron_obj, limb_stats = lp.decompose_limbs_parallel(mesh, 1, products, n_workers=2)
+
+    assert limb_stats["n_serial_limbs"] == 0
+    assert limb_stats["limb_faces"] == [len(m.faces) for m in products["limb_meshes"]]
+    # every limb was decomposed in a worker, and the neuron is assembled exactly as serially
+    assert all(c["pid"] != os.getpid() for c in neuron_obj.limb_correspondence.values())
+    for c in list(neuron_obj.limb_correspondence.values()) + list(serial.limb_correspondence.values()):
+        c.pop("pid")
+    assert lp.compare_objects(serial.limb_correspondence, neuron_obj.limb_correspondence) == []
+    assert lp.compare_objects(serial.pipeline_products, neuron_obj.pipeline_products) == []
+
+
+def test_changed_limb_falls_back_to_serial(stub_neurd, mesh, products, monkeypatch):
+    build_neuron = lp.build_neuron
+    shifted_mesh = products["limb_meshes"][1].copy().apply_translation([0, 1, 0])
+    n_builds = 0
+
+    # the limb mesh of the second (replay) pass differs from the one decomposed in parallel
+    def changing_build_neuron(mesh_decimated, segment_id, products):
+        nonlocal n_builds
+        n_builds += 1
+        if n_builds > 1:
+            products = copy.deepcopy(products)
+            products["limb_meshes"][1] = shifted_mesh
+        return build_neuron(mesh_decimated, segment_id, products)
+
+    monkeypatch.setattr(lp, "build_neuron", changing_build_neuron)
+    neuron_obj, limb_stats = lp.decompose_limbs_parallel(mesh, 1, products, n_workers=2)
+
+    assert limb_stats["n_serial_limbs"] == 1
+    assert neuron_obj.limb_correspondence[1]["pid"] == os.getpid()
+    assert np.allclose(neuron_obj.limb_correspondence[1]["centroid"], shifted_mesh.vertices.mean(axis=0))
+    assert neuron_obj.limb_correspondence[0]["pid"] != os.getpid()
+
+
+def test_neurd_parallel_matches_serial():
+    # needs the outputs of stages 02 and 03 of a segment, e.g. NEURD_TEST_DIR=results/ NEURD_TEST_SEGMENT_ID=864691136361538530
+    pytest.importorskip("neurd")
+    base_dir = os.environ.get("NEURD_TEST_DIR")
+    segment_id = os.environ.get("NEURD_TEST_SEGMENT_ID")
+    if base_dir is None or segment_id is None:
+        pytest.skip("NEURD_TEST_DIR and NEURD_TEST_SEGMENT_ID are not set")
+
+    from neurd.vdi_microns import volume_data_interface as vdi
+    from datasci_tools import system_utils as su
+
+    segment_id = int(segment_id)
+    mesh_decimated = vdi.fetch_segment_id_mesh(mesh_filepath=f"{base_dir}{segment_id}_decimated.off")
+    products = su.load_object(f"{base_dir}{segment_id}_products.pkl")
+
+    neuron_obj, limb_stats = lp.decompose_limbs_parallel(mesh_decimated, segment_id, products, n_workers=2)
+
+    assert limb_stats["n_serial_limbs"] == 0
+    assert lp.compare_neurons(lp.build_neuron(mesh_decimated, segment_id, products), neuron_obj) == []
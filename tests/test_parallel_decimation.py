@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("trimesh")
+pytest.importorskip("pyfqmr")
+
+import parallel_decimation as pdec
+
+DECIMATION_RATIO = 0.062
+
+
+@pytest.fixture(scope="module", params=[0, 20], ids=["closed", "holes"])
+def mesh(request):
+    return pdec.synthetic_mesh(subdivisions=6, n_holes=request.param)
+
+
+@pytest.fixture(scope="module")
+def decimated(mesh):
+    return pdec.decimate_parallel(mesh, DECIMATION_RATIO, n_workers=2, n_partitions=4)
+
+
+@pytest.fixture(scope="module")
+def reference(mesh):
+    return pdec.decimate_mesh(mesh, DECIMATION_RATIO)
+
+
+def test_face_count(mesh, decimated):
+    target = len(mesh.faces) * DECIMATION_RATIO
+    assert abs(len(decimated.faces) - target) <= 0.05 * target
+
+
+def test_partitions_are_welded(mesh, decimated):
+    # the cuts between partitions leave no borders, only the holes of the mesh stay open
+    mesh_borders = np.unique(mesh.vertices[pdec.boundary_edges(mesh)].reshape(-1, 3), axis=0)
+    decimated_borders = np.unique(decimated.vertices[pdec.boundary_edges(decimated)].reshape(-1, 3), axis=0)
+
+    assert len(pdec.boundary_edges(decimated)) == len(pdec.boundary_edges(mesh))
+    assert np.array_equal(mesh_borders, decimated_borders)
+    if len(mesh_borders) == 0:
+        assert decimated.is_watertight
+
+
+def test_quality_against_reference(mesh, decimated, reference):
+    comparison = pdec.compare_decimations(mesh, decimated, reference)
+
+    assert comparison["quality"] >= 0.85 * comparison["reference_quality"]
+    assert comparison["distance"]["mean"] <= 1.25 * comparison["reference_distance"]["mean"]
+    assert comparison["distance"]["max"] <= 2 * comparison["reference_distance"]["max"]
@@ -0,0 +1,81 @@
+import numpy as np
+import pytest
+
+trimesh = pytest.importorskip("trimesh")
+DracoPy = pytest.importorskip("DracoPy")
+
+import precomputed_export as pe
+
+RADIUS = 150
+LENGTH = 300000
+
+
+def decode_multilod_draco(data, manifest, vertex_quantization_bits=pe.VERTEX_QUANTIZATION_BITS):
+    # reads the manifest the way neuroglancer does and returns the vertices and faces of every level
+    chunk_shape = np.frombuffer(manifest, "<f4", 3, 0)
+    grid_origin = np.frombuffer(manifest, "<f4", 3, 12)
+    n_lods = int(np.frombuffer(manifest, "<u4", 1, 24)[0])
+    offset = 28 + 4 * n_lods + 12 * n_lods
+    n_fragments = np.frombuffer(manifest, "<u4", n_lods, offset)
+    offset += 4 * n_lods
+
+    max_quantized = 2 ** vertex_quantization_bits - 1
+    lods = []
+    data_offset = 0
+    for lod in range(n_lods):
+        n = int(n_fragments[lod])
+        positions = np.frombuffer(manifest, "<u4", 3 * n, offset).reshape(3, n).T
+        sizes = np.frombuffer(manifest, "<u4", n, offset + 12 * n)
+        offset += 16 * n
+
+        vertices, faces = [], []
+        n_vertices = 0
+        for position, size in zip(positions, sizes):
+            fragment = DracoPy.decode(data[data_offset:data_offset + size])
+            data_offset += size
+            points = np.asarray(fragment.points, dtype=np.float64).reshape(-1, 3)
+            vertices.append(grid_origin + chunk_shape * 2 ** lod * (position + points / max_quantized))
+            faces.append(np.asarray(fragment.faces).reshape(-1, 3) + n_vertices)
+            n_vertices += len(points)
+        lods.append((np.concatenate(vertices), np.concatenate(faces)))
+
+    assert data_offset == len(data)
+    return lods
+
+
+@pytest.fixture(scope="module")
+def tube():
+    # thin axon running diagonally through a neuron sized bounding box
+    end = np.full(3, LENGTH / np.sqrt(3))
+    return trimesh.creation.cylinder(radius=RADIUS, segment=[np.zeros(3), end], sections=16)
+
+
+def vertex_error(mesh, vertices):
+    return trimesh.proximity.closest_point_naive(mesh, vertices)[1]
+
+
+def test_thin_tube_round_trip(tube):
+    data, manifest = pe.encode_multilod_draco([(tube.vertices, tube.faces)])
+    [(vertices, faces)] = decode_multilod_draco(data, manifest)
+
+    # the tube is longer than MAX_CHUNK_SIZE, so it is split into several fragments
+    assert len(faces) > len(tube.faces)
+    assert vertex_error(tube, vertices).max() < RADIUS / 10
+
+
+def test_single_fragment_round_trip(tube):
+    data, manifest = pe.encode_multilod_draco([(tube.vertices, tube.faces)], max_chunk_size=np.inf)
+    [(vertices, faces)] = decode_multilod_draco(data, manifest)
+
+    assert len(faces) == len(tube.faces)
+    assert vertex_error(tube, vertices).max() < RADIUS / 10
+
+
+def test_levels_of_detail_round_trip(tube):
+    mesh = tube.subdivide().subdivide().subdivide()
+    lods = pe.mesh_lods(mesh.vertices, mesh.faces, n_lods=3, min_faces=10)
+    data, manifest = pe.encode_multilod_draco(lods)
+
+    for (vertices, faces), (decoded_vertices, decoded_faces) in zip(lods, decode_multilod_draco(data, manifest)):
+        lod_mesh = trimesh.Trimesh(vertices, faces, process=False)
+        assert vertex_error(lod_mesh, decoded_vertices).max() < RADIUS / 10
@@ -0,0 +1,36 @@
+import pytest
+
+pytest.importorskip("kimimaro")
+
+import skeleton_graph as sg
+import skeletonization_comparison as sc
+
+ANISOTROPY = (40, 4, 4)
+
+# splits and merges of sg.make_synthetic_volume(): ground truth label -> proofread labels covering it,
+# proofread label -> ground truth labels it covers
+SYNTHETIC_SPLITS = {12: [12, 32], 16: [16, 36], 17: [17, 37]}
+SYNTHETIC_MERGES = {10: [5, 10], 18: [18, 20]}
+
+
+@pytest.fixture(scope="module")
+def comparison():
+    gt_seg, proof_seg = sg.make_synthetic_volume()
+    return sc.compare_skeletons(
+        sc.skeletonize(gt_seg, ANISOTROPY),
+        sc.skeletonize(proof_seg, ANISOTROPY),
+        tolerance=500,
+    )
+
+
+def test_synthetic_splits_and_merges(comparison):
+    assert comparison["splits"] == SYNTHETIC_SPLITS
+    assert comparison["merges"] == SYNTHETIC_MERGES
+
+
+def test_synthetic_summary(comparison):
+    summary = sc.summarize(comparison)
+    assert summary["recall"] == 1.0
+    assert summary["precision"] == 1.0
+    assert summary["n_splits"] == len(SYNTHETIC_SPLITS)
+    assert summary["n_merges"] == len(SYNTHETIC_MERGES)